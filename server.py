@@ -12,29 +12,158 @@ import gc
 import io
 import traceback
 import threading
+import logging
+import atexit
+from collections import defaultdict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 app = Flask(__name__)
 app.config['PROPAGATE_EXCEPTIONS'] = True
 CORS(app, origins=["https://jwlibrarycopie.netlify.app"])
 
+# Détail ligne par ligne des fusions : logger.debug, jamais formaté au niveau par défaut.
+# MERGE_VERBOSE=1 dans l'environnement réactive ce détail.
+logger = logging.getLogger(__name__)
+if os.environ.get("MERGE_VERBOSE") == "1":
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
+
 UPLOAD_FOLDER = "uploads"
 EXTRACT_FOLDER = "extracted"
+# Tampon de copie des fichiers envoyés (Werkzeug copie par blocs de 16 Kio par défaut)
+UPLOAD_BUFFER_SIZE = 8 * 1024 * 1024
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(EXTRACT_FOLDER, exist_ok=True)
 
+# PRAGMAs appliqués sur la base fusionnée avant les grosses boucles d'insertion :
+# WAL + synchronous=OFF évitent les fsync pendant l'ingestion, le cache garde les B-trees en mémoire.
+# La base fusionnée est reconstruite à chaque /merge et livrée via VACUUM INTO, donc rien n'est
+# perdu si le processus s'arrête en cours de route.
+MERGE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA foreign_keys=OFF",
+)
+
+
+def apply_merge_pragmas(conn):
+    for pragma in MERGE_PRAGMAS:
+        conn.execute(pragma)
+
+
+def open_merged_db(db_path, conn=None):
+    """
+    Connexion d'écriture vers la base fusionnée. Mode autocommit du driver :
+    chaque fonction de fusion ouvre elle-même sa transaction (BEGIN ... COMMIT).
+    Si 'conn' est fourni (connexion partagée par merge_data), il est réutilisé tel quel.
+    """
+    if conn is not None:
+        return conn
+    conn = sqlite3.connect(db_path, isolation_level=None, cached_statements=256, uri=True)
+    apply_merge_pragmas(conn)
+    return conn
+
+
+def load_id_map_into_temp(conn, table_name, id_map):
+    """
+    Copie un mapping {(source_db, ancien_id): nouvel_id} dans la table temporaire
+    temp.<table_name>(SourceDb, OldId, NewId) de la connexion, pour que les
+    fusions réécrivent les IDs par jointure (INSERT … SELECT) plutôt qu'en Python.
+    """
+    conn.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {table_name} (
+            SourceDb TEXT,
+            OldId INTEGER,
+            NewId INTEGER,
+            PRIMARY KEY (SourceDb, OldId)
+        ) WITHOUT ROWID
+    """)
+    conn.execute(f"DELETE FROM temp.{table_name}")
+    conn.executemany(
+        f"INSERT OR IGNORE INTO temp.{table_name} (SourceDb, OldId, NewId) VALUES (?, ?, ?)",
+        ((src, old_id, new_id) for (src, old_id), new_id in id_map.items())
+    )
+
+
+# Connexions en lecture seule vers les bases sources, gardées ouvertes entre les appels
+# pour conserver le schéma et le cache de pages. Vidé à chaque nouvel upload.
+RO_CONN_CACHE = {}
+RO_CONN_LOCK = threading.Lock()
+
+
+def get_conn(db_path):
+    key = os.path.abspath(db_path)
+    with RO_CONN_LOCK:
+        conn = RO_CONN_CACHE.get(key)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{key}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute("PRAGMA cache_size=-16384")
+            RO_CONN_CACHE[key] = conn
+        return conn
+
+
+def close_cached_conns():
+    with RO_CONN_LOCK:
+        for conn in RO_CONN_CACHE.values():
+            conn.close()
+        RO_CONN_CACHE.clear()
+
+
+# Connexions en cache fermées proprement à l'arrêt du process
+atexit.register(close_cached_conns)
+
+
+@lru_cache(maxsize=4096)
+def cached_normpath(path):
+    # Les mêmes chemins de bases reviennent dans toutes les clés de mapping
+    return os.path.normpath(path)
+
+
+@lru_cache(maxsize=64)
+def cached_basename(path):
+    # Nom de fichier des bases sources, recalculé sinon à chaque message dans les boucles de fusion
+    return os.path.basename(path)
+
+
+def json_response(data):
+    # orjson (si installé) sérialise les gros aperçus bien plus vite que json/jsonify
+    if orjson is not None:
+        return app.response_class(orjson.dumps(data), mimetype="application/json")
+    return jsonify(data)
+
 
 def normalize_mapping_keys(mapping):
     return {
-        (os.path.normpath(k[0]), k[1]): v
+        (cached_normpath(k[0]), k[1]): v
         for k, v in mapping.items()
     }
 
 
+def mapping_by_db(mapping):
+    """
+    Transforme {(chemin_db, ancien_id): nouvel_id} en {chemin_db_normalisé: {ancien_id: nouvel_id}}.
+    Les recherches dans les boucles se font alors sans construire de tuple.
+    """
+    by_db = {}
+    for (db_path, old_id), new_id in mapping.items():
+        by_db.setdefault(cached_normpath(db_path), {})[old_id] = new_id
+    return by_db
+
+
 def get_current_local_iso8601():
-    now_local = datetime.datetime.now()
-    return now_local.strftime("%Y-%m-%dT%H:%M:%S")
+    return datetime.now().isoformat(timespec='seconds')
 
 
 def checkpoint_db(db_path):
@@ -75,46 +204,45 @@ def merge_independent_media(merged_db_path, file1_db, file2_db):
     """
     print("\n[FUSION INDEPENDENTMEDIA]")
     mapping = {}
-    with sqlite3.connect(merged_db_path) as merged_conn:
+    with sqlite3.connect(merged_db_path, cached_statements=256, uri=True) as merged_conn:
+        apply_merge_pragmas(merged_conn)
         merged_cursor = merged_conn.cursor()
-
-        for db_path in [file1_db, file2_db]:
+        # Les lignes identiques (OriginalFilename, FilePath, Hash) sont réutilisées ; toute autre ligne est
+        # insérée normalement, si bien qu'un FilePath déjà pris avec d'autres données fait échouer la fusion
+        # (contrainte UNIQUE de IndependentMedia.FilePath), comme la version ligne par ligne.
+        # L'autoindex de FilePath sert le NOT EXISTS et la jointure du mapping.
+        # Copie entièrement côté SQLite : chaque source est attachée puis fusionnée en un INSERT…SELECT
+        for alias, db_path in (("src1", file1_db), ("src2", file2_db)):
             print(f"Traitement de {db_path}")
-            with sqlite3.connect(db_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                src_cursor.execute("""
-                    SELECT IndependentMediaId, OriginalFilename, FilePath, MimeType, Hash
-                    FROM IndependentMedia
-                """)
-                rows = src_cursor.fetchall()
-
-                for row in rows:
-                    old_id, orig_fn, file_path, mime, hash_val = row
-                    print(f"  - Média : {orig_fn}, Hash={hash_val}")
-
-                    # Vérifie si la ligne existe déjà (évite doublons)
-                    merged_cursor.execute("""
-                        SELECT IndependentMediaId, MimeType
-                        FROM IndependentMedia
-                        WHERE OriginalFilename = ? AND FilePath = ? AND Hash = ?
-                    """, (orig_fn, file_path, hash_val))
-                    result = merged_cursor.fetchone()
-
-                    if result:
-                        new_id, existing_mime = result
-                        # Au lieu de mettre à jour le MimeType, on ignore simplement la nouvelle ligne
-                        print(f"    > Ligne déjà présente pour ID {new_id} (ignorée pour {db_path})")
-                    else:
-                        merged_cursor.execute("""
-                            INSERT INTO IndependentMedia (OriginalFilename, FilePath, MimeType, Hash)
-                            VALUES (?, ?, ?, ?)
-                        """, (orig_fn, file_path, mime, hash_val))
-                        new_id = merged_cursor.lastrowid
-                        print(f"    > Insertion nouvelle ligne ID {new_id}")
-
-                    mapping[(db_path, old_id)] = new_id
+            merged_conn.execute(f"ATTACH DATABASE ? AS {alias}", (f"file:{os.path.abspath(db_path)}?mode=ro",))
+            merged_conn.execute("BEGIN")
+            merged_cursor.execute(f"""
+                INSERT INTO main.IndependentMedia (OriginalFilename, FilePath, MimeType, Hash)
+                SELECT s.OriginalFilename, s.FilePath, s.MimeType, s.Hash
+                FROM {alias}.IndependentMedia s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM main.IndependentMedia m
+                    WHERE m.FilePath = s.FilePath
+                      AND m.OriginalFilename = s.OriginalFilename
+                      AND m.Hash = s.Hash
+                )
+            """)
+            print(f"  - {merged_cursor.rowcount} média(s) inséré(s)")
+
+            # Mapping ancien ID -> nouvel ID par jointure sur la clé de dédoublonnage
+            merged_cursor.execute(f"""
+                SELECT s.IndependentMediaId, m.IndependentMediaId
+                FROM {alias}.IndependentMedia s
+                JOIN main.IndependentMedia m
+                  ON m.FilePath = s.FilePath
+                 AND m.OriginalFilename = s.OriginalFilename
+                 AND m.Hash = s.Hash
+            """)
+            for old_id, new_id in merged_cursor.fetchall():
+                mapping[(db_path, old_id)] = new_id
 
-        merged_conn.commit()
+            merged_conn.commit()
+            merged_conn.execute(f"DETACH DATABASE {alias}")
 
     print("Fusion IndependentMedia terminée.", flush=True)
     return mapping
@@ -123,8 +251,7 @@ def merge_independent_media(merged_db_path, file1_db, file2_db):
 def read_notes_and_highlights(db_path):
     if not os.path.exists(db_path):
         return {"error": f"Base de données introuvable : {db_path}"}
-    checkpoint_db(db_path)
-    conn = sqlite3.connect(db_path)
+    conn = get_conn(db_path)
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -141,16 +268,21 @@ def read_notes_and_highlights(db_path):
     """)
     highlights = cursor.fetchall()
 
-    conn.close()
     return {"notes": notes, "highlights": highlights}
 
 
 def generate_preview_data(file1_db, file2_db):
-    return {
-        "notes": compare_notes_with_preview(file1_db, file2_db),
-        "bookmarks": compare_bookmarks_with_preview(file1_db, file2_db),
-        "tags": compare_tags_with_preview(file1_db, file2_db)
-    }
+    # Une seule connexion : file2 est attaché à file1 et chaque comparaison est une requête SQL
+    conn = sqlite3.connect(f"file:{os.path.abspath(file1_db)}?mode=ro", uri=True)
+    try:
+        conn.execute("ATTACH DATABASE ? AS f2", (f"file:{os.path.abspath(file2_db)}?mode=ro",))
+        return {
+            "notes": compare_notes_with_preview(conn),
+            "bookmarks": compare_bookmarks_with_preview(conn),
+            "tags": compare_tags_with_preview(conn)
+        }
+    finally:
+        conn.close()
 
 
 @app.route('/prepare-preview', methods=['POST'])
@@ -162,88 +294,71 @@ def prepare_preview():
         if not os.path.exists(file1_path) or not os.path.exists(file2_path):
             return jsonify({"error": "Fichiers non trouvés"}), 400
 
-        conn1 = sqlite3.connect(file1_path)
-        conn2 = sqlite3.connect(file2_path)
+        def extract_table(db_path, table_name):
+            # Une connexion propre à chaque thread (les lectures sont lancées en parallèle)
+            conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+            try:
+                # Format colonne : noms de colonnes une seule fois + lignes en tableaux
+                # (le front reconstruit les objets, voir unpackPreviewTables dans index.html)
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT * FROM {table_name}")
+                columns = [desc[0] for desc in cursor.description]
+                return {"columns": columns, "rows": [list(row) for row in cursor]}
+            finally:
+                conn.close()
 
-        def extract_table(conn, table_name):
-            cursor = conn.cursor()
-            cursor.execute(f"SELECT * FROM {table_name}")
-            columns = [desc[0] for desc in cursor.description]
-            return [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-        # Tu extrais chaque table
-        notes1 = extract_table(conn1, "Note")
-        notes2 = extract_table(conn2, "Note")
-        bookmarks1 = extract_table(conn1, "Bookmark")
-        bookmarks2 = extract_table(conn2, "Bookmark")
-        tags1 = extract_table(conn1, "Tag")
-        tags2 = extract_table(conn2, "Tag")
-
-        # Extraire TagMap pour chaque fichier (aucun filtre appliqué)
-        tagmaps1_all = extract_table(conn1, "TagMap")
-        tagmaps1 = tagmaps1_all  # on garde tout
-        tagmaps2_all = extract_table(conn2, "TagMap")
-        tagmaps2 = tagmaps2_all  # on garde tout
-
-        conn1.close()
-        conn2.close()
+        # TagMap est renvoyé en entier pour chaque fichier (aucun filtre appliqué)
+        preview_tables = {"notes": "Note", "bookmarks": "Bookmark", "tags": "Tag", "tagMaps": "TagMap"}
+        source_files = {"file1": file1_path, "file2": file2_path}
+
+        # Les 8 lectures sont indépendantes : sqlite3 relâche le GIL pendant les requêtes
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                key: {
+                    file_key: executor.submit(extract_table, path, table_name)
+                    for file_key, path in source_files.items()
+                }
+                for key, table_name in preview_tables.items()
+            }
 
         # Tu renvoies les données sous la bonne structure
         response = {
-            "notes": {
-                "file1": notes1,
-                "file2": notes2
-            },
-            "bookmarks": {
-                "file1": bookmarks1,
-                "file2": bookmarks2
-            },
-            "tags": {
-                "file1": tags1,
-                "file2": tags2
-            },
-            "tagMaps": {
-                "file1": tagmaps1,
-                "file2": tagmaps2
-            }
+            key: {file_key: future.result() for file_key, future in per_file.items()}
+            for key, per_file in futures.items()
         }
 
-        return jsonify(response)
+        return json_response(response)
 
     except Exception as e:
         print("Erreur /prepare-preview:", str(e))
         return jsonify({"error": str(e)}), 500
 
 
-def compare_notes_with_preview(file1_db, file2_db):
-    import sqlite3
-
-    conn1 = sqlite3.connect(file1_db)
-    conn2 = sqlite3.connect(file2_db)
-    cur1 = conn1.cursor()
-    cur2 = conn2.cursor()
-
-    cur1.execute("SELECT NoteGUID, Title, Content, LastModified FROM Note")
-    notes1 = {row[0]: row[1:] for row in cur1.fetchall()}
-
-    cur2.execute("SELECT NoteGUID, Title, Content, LastModified FROM Note")
-    notes2 = {row[0]: row[1:] for row in cur2.fetchall()}
+# Format colonne des comparaisons : une ligne = [id, status, defaultChoice, file1, file2, merged],
+# file1/file2/merged étant des tableaux dans l'ordre de "fields" (ou null).
+PREVIEW_COLUMNS = ["id", "status", "defaultChoice", "file1", "file2", "merged"]
 
-    all_guids = set(notes1.keys()) | set(notes2.keys())
-    results = []
 
-    for guid in all_guids:
-        n1 = notes1.get(guid)
-        n2 = notes2.get(guid)
+def compare_notes_with_preview(conn):
+    """
+    Compare les notes de main (file1) et f2 (file2) par Guid.
+    FULL OUTER JOIN émulé : LEFT JOIN + lignes de f2 absentes de main.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT a.Guid, b.Guid, a.Title, a.Content, a.LastModified, b.Title, b.Content, b.LastModified
+        FROM main.Note a
+        LEFT JOIN f2.Note b ON b.Guid = a.Guid
+        UNION ALL
+        SELECT NULL, b.Guid, NULL, NULL, NULL, b.Title, b.Content, b.LastModified
+        FROM f2.Note b
+        WHERE NOT EXISTS (SELECT 1 FROM main.Note a WHERE a.Guid = b.Guid)
+    """)
 
-        def dictify(row):
-            if not row:
-                return None
-            return {
-                "title": row[0],
-                "content": row[1],
-                "lastModified": row[2]
-            }
+    rows = []
+    for guid1, guid2, *values in cursor:
+        n1 = values[:3] if guid1 is not None else None
+        n2 = values[3:] if guid2 is not None else None
 
         merged = None
         status = "identical"
@@ -252,56 +367,37 @@ def compare_notes_with_preview(file1_db, file2_db):
         if n1 and n2:
             status = "identical" if n1 == n2 else "different"
             default = "file2" if n2[2] > n1[2] else "file1"
-            merged = dictify(n2) if default == "file2" else dictify(n1)
+            merged = n2 if default == "file2" else n1
         elif n1:
             status = "only_file1"
             default = "file1"
-            merged = dictify(n1)
+            merged = n1
         elif n2:
             status = "only_file2"
             default = "file2"
-            merged = dictify(n2)
-
-        results.append({
-            "guid": guid,
-            "file1": dictify(n1),
-            "file2": dictify(n2),
-            "merged": merged,
-            "status": status,
-            "defaultChoice": default
-        })
-
-    conn1.close()
-    conn2.close()
-    return results
-
-
-def compare_bookmarks_with_preview(file1_db, file2_db):
-    conn1 = sqlite3.connect(file1_db)
-    conn2 = sqlite3.connect(file2_db)
-    cur1 = conn1.cursor()
-    cur2 = conn2.cursor()
-
-    cur1.execute("SELECT BookmarkId, LocationId, Title FROM Bookmark")
-    bookmarks1 = {row[0]: row[1:] for row in cur1.fetchall()}
-
-    cur2.execute("SELECT BookmarkId, LocationId, Title FROM Bookmark")
-    bookmarks2 = {row[0]: row[1:] for row in cur2.fetchall()}
-
-    all_ids = set(bookmarks1.keys()) | set(bookmarks2.keys())
-    results = []
-
-    for bid in all_ids:
-        b1 = bookmarks1.get(bid)
-        b2 = bookmarks2.get(bid)
-
-        def dictify(b):
-            if not b:
-                return None
-            return {
-                "locationId": b[0],
-                "title": b[1]
-            }
+            merged = n2
+
+        rows.append([guid1 if guid1 is not None else guid2, status, default, n1, n2, merged])
+
+    return {"columns": PREVIEW_COLUMNS, "fields": ["title", "content", "lastModified"], "rows": rows}
+
+
+def compare_bookmarks_with_preview(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT a.BookmarkId, b.BookmarkId, a.LocationId, a.Title, b.LocationId, b.Title
+        FROM main.Bookmark a
+        LEFT JOIN f2.Bookmark b ON b.BookmarkId = a.BookmarkId
+        UNION ALL
+        SELECT NULL, b.BookmarkId, NULL, NULL, b.LocationId, b.Title
+        FROM f2.Bookmark b
+        WHERE NOT EXISTS (SELECT 1 FROM main.Bookmark a WHERE a.BookmarkId = b.BookmarkId)
+    """)
+
+    rows = []
+    for id1, id2, loc1, title1, loc2, title2 in cursor:
+        b1 = [loc1, title1] if id1 is not None else None
+        b2 = [loc2, title2] if id2 is not None else None
 
         status = "identical"
         default = None
@@ -310,49 +406,35 @@ def compare_bookmarks_with_preview(file1_db, file2_db):
         if b1 and b2:
             status = "identical" if b1 == b2 else "different"
             default = "file2"
-            merged = dictify(b2)
+            merged = b2
         elif b1:
             status = "only_file1"
             default = "file1"
-            merged = dictify(b1)
+            merged = b1
         elif b2:
             status = "only_file2"
             default = "file2"
-            merged = dictify(b2)
-
-        results.append({
-            "id": bid,
-            "file1": dictify(b1),
-            "file2": dictify(b2),
-            "merged": merged,
-            "status": status,
-            "defaultChoice": default
-        })
-
-    conn1.close()
-    conn2.close()
-    return results
+            merged = b2
 
+        rows.append([id1 if id1 is not None else id2, status, default, b1, b2, merged])
 
-def compare_tags_with_preview(file1_db, file2_db):
-    conn1 = sqlite3.connect(file1_db)
-    conn2 = sqlite3.connect(file2_db)
-    cur1 = conn1.cursor()
-    cur2 = conn2.cursor()
+    return {"columns": PREVIEW_COLUMNS, "fields": ["locationId", "title"], "rows": rows}
 
-    cur1.execute("SELECT TagId, Name FROM Tag")
-    tags1 = {row[0]: row[1] for row in cur1.fetchall()}
 
-    cur2.execute("SELECT TagId, Name FROM Tag")
-    tags2 = {row[0]: row[1] for row in cur2.fetchall()}
-
-    all_ids = set(tags1.keys()) | set(tags2.keys())
-    results = []
-
-    for tid in all_ids:
-        name1 = tags1.get(tid)
-        name2 = tags2.get(tid)
+def compare_tags_with_preview(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT a.TagId, a.Name, b.Name
+        FROM main.Tag a
+        LEFT JOIN f2.Tag b ON b.TagId = a.TagId
+        UNION ALL
+        SELECT b.TagId, NULL, b.Name
+        FROM f2.Tag b
+        WHERE NOT EXISTS (SELECT 1 FROM main.Tag a WHERE a.TagId = b.TagId)
+    """)
 
+    rows = []
+    for tid, name1, name2 in cursor:
         status = "identical"
         default = None
         merged = None
@@ -370,18 +452,14 @@ def compare_tags_with_preview(file1_db, file2_db):
             default = "file2"
             merged = name2
 
-        results.append({
-            "id": tid,
-            "file1": { "name": name1 } if name1 else None,
-            "file2": { "name": name2 } if name2 else None,
-            "merged": { "name": merged } if merged else None,
-            "status": status,
-            "defaultChoice": default
-        })
+        rows.append([
+            tid, status, default,
+            [name1] if name1 else None,
+            [name2] if name2 else None,
+            [merged] if merged else None
+        ])
 
-    conn1.close()
-    conn2.close()
-    return results
+    return {"columns": PREVIEW_COLUMNS, "fields": ["name"], "rows": rows}
 
 
 @app.route('/preview-merge', methods=['GET'])
@@ -392,8 +470,10 @@ def preview_merge():
     if not os.path.exists(file1) or not os.path.exists(file2):
         return jsonify({"error": "Fichiers source manquants"}), 400
 
+    checkpoint_db(file1)
+    checkpoint_db(file2)
     preview_data = generate_preview_data(file1, file2)
-    return jsonify(preview_data), 200
+    return json_response(preview_data), 200
 
 
 def extract_file(file_path, extract_folder):
@@ -409,7 +489,6 @@ def extract_file(file_path, extract_folder):
 
 
 def create_merged_schema(merged_db_path, base_db_path):
-    checkpoint_db(base_db_path)
     src_conn = sqlite3.connect(base_db_path)
     src_cursor = src_conn.cursor()
     src_cursor.execute(
@@ -422,11 +501,29 @@ def create_merged_schema(merged_db_path, base_db_path):
 
     merged_conn = sqlite3.connect(merged_db_path)
     merged_cursor = merged_conn.cursor()
+    deferred_indexes = []
+    ddl_items = []
     for obj_type, name, sql in schema_items:
         # On exclut la table (et triggers associés) LastModified
         if (obj_type == 'table' and name == "LastModified") or (obj_type == 'trigger' and "LastModified" in sql):
             continue
+        # Les index non uniques sont créés après le chargement des données (voir merge_data)
+        if obj_type == 'index' and sql and not sql.lstrip().upper().startswith("CREATE UNIQUE"):
+            deferred_indexes.append(sql)
+            continue
         if sql:
+            ddl_items.append((obj_type, name, sql))
+
+    # Tout le DDL en un seul script et une seule transaction ;
+    # en cas d'échec on annule et on repasse objet par objet pour isoler l'erreur.
+    try:
+        merged_conn.executescript(
+            "BEGIN;\n" + ";\n".join(sql for _, _, sql in ddl_items) + ";\nCOMMIT;"
+        )
+    except sqlite3.Error as e:
+        print(f"Erreur dans le script de schéma ({e}), création objet par objet")
+        merged_conn.rollback()
+        for obj_type, name, sql in ddl_items:
             try:
                 merged_cursor.execute(sql)
             except Exception as e:
@@ -459,6 +556,7 @@ def create_merged_schema(merged_db_path, base_db_path):
 
     merged_conn.commit()
     merged_conn.close()
+    return deferred_indexes
 
 
 def create_table_if_missing(merged_conn, source_db_paths, table):
@@ -467,7 +565,6 @@ def create_table_if_missing(merged_conn, source_db_paths, table):
     if cursor.fetchone() is None:
         create_sql = None
         for db_path in source_db_paths:
-            checkpoint_db(db_path)
             src_conn = sqlite3.connect(db_path)
             src_cursor = src_conn.cursor()
             src_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
@@ -496,10 +593,6 @@ def merge_other_tables(merged_db_path, db1_path, db2_path, exclude_tables=None):
     if exclude_tables is None:
         exclude_tables = ["Note", "UserMark", "Bookmark", "InputField"]
 
-    # On effectue un checkpoint pour s'assurer que les données sont bien synchronisées.
-    checkpoint_db(db1_path)
-    checkpoint_db(db2_path)
-
     def get_tables(path):
         with sqlite3.connect(path) as conn:
             cursor = conn.cursor()
@@ -510,64 +603,98 @@ def merge_other_tables(merged_db_path, db1_path, db2_path, exclude_tables=None):
     tables2 = get_tables(db2_path)
     all_tables = (tables1 | tables2) - set(exclude_tables)
 
-    merged_conn = sqlite3.connect(merged_db_path)
+    merged_conn = sqlite3.connect(merged_db_path, cached_statements=256)
+    apply_merge_pragmas(merged_conn)
+    merged_conn.execute("BEGIN")
     merged_cursor = merged_conn.cursor()
     source_db_paths = [db1_path, db2_path]
 
-    for table in all_tables:
-        # Crée la table dans la DB fusionnée si elle est manquante
-        create_table_if_missing(merged_conn, source_db_paths, table)
-        merged_cursor.execute(f"PRAGMA table_info({table})")
-        columns_info = merged_cursor.fetchall()
-        if not columns_info:
-            print(f"❌ Table {table} introuvable dans la DB fusionnée.")
-            continue
+    try:
+        for table in all_tables:
+            # Crée la table dans la DB fusionnée si elle est manquante
+            create_table_if_missing(merged_conn, source_db_paths, table)
+            merged_cursor.execute(f"PRAGMA table_info({table})")
+            columns_info = merged_cursor.fetchall()
+            if not columns_info:
+                print(f"❌ Table {table} introuvable dans la DB fusionnée.")
+                continue
 
-        # 🔵 Sécurisation forte : tout est string forcée
-        columns = [str(col[1]) for col in columns_info]
-        columns_joined = ", ".join(columns)
-        placeholders = ", ".join(["?"] * len(columns))
+            # 🔵 Sécurisation forte : tout est string forcée
+            columns = [str(col[1]) for col in columns_info]
+            columns_joined = ", ".join(columns)
+            placeholders = ", ".join(["?"] * len(columns))
+
+            # Hash join : les lignes déjà présentes (hors clé primaire) sont chargées une seule fois.
+            # Une clé contenant NULL n'est jamais considérée comme doublon (même logique que "col=?").
+            existing = set()
+            if len(columns) > 1:
+                merged_cursor.execute(f"SELECT {', '.join(columns[1:])} FROM {table}")
+                existing = {tuple(r) for r in merged_cursor.fetchall() if None not in r}
+            # Clé primaire INTEGER simple (alias du rowid) : SQLite attribue lui-même le nouvel ID.
+            # Sinon (clé composite, WITHOUT ROWID...) on garde un compteur initialisé une seule fois.
+            pk_columns = [col for col in columns_info if col[5] > 0]
+            auto_id = (
+                len(columns) > 1 and len(pk_columns) == 1 and pk_columns[0][1] == columns[0]
+                and str(pk_columns[0][2]).upper() == "INTEGER"
+            )
+            if auto_id:
+                next_id = None
+                insert_sql = (
+                    f"INSERT OR IGNORE INTO {table} ({', '.join(columns[1:])}) "
+                    f"VALUES ({', '.join(['?'] * (len(columns) - 1))})"
+                )
+            else:
+                cur_max = merged_cursor.execute(f"SELECT MAX({columns[0]}) FROM {table}").fetchone()[0] or 0
+                next_id = int(cur_max) + 1
+                insert_sql = f"INSERT OR IGNORE INTO {table} ({columns_joined}) VALUES ({placeholders})"
 
-        for source_path in source_db_paths:
-            with sqlite3.connect(source_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                try:
-                    src_cursor.execute(f"SELECT * FROM {table}")
-                    rows = src_cursor.fetchall()
-                except Exception as e:
-                    print(f"⚠️ Erreur lecture de {table} depuis {source_path}: {e}")
-                    rows = []
-
-                for row in rows:
-                    if len(columns) > 1:
-                        where_clause = " AND ".join([f"{str(col)}=?" for col in columns[1:]])
-                        check_query = f"SELECT 1 FROM {table} WHERE {where_clause} LIMIT 1"
-                        merged_cursor.execute(check_query, row[1:])
-                        exists = merged_cursor.fetchone()
-                    else:
-                        # Cas spécial : table avec seulement clé primaire
-                        exists = None
-
-                    if not exists:
-                        cur_max = merged_cursor.execute(f"SELECT MAX({str(columns[0])}) FROM {table}").fetchone()[
-                                      0] or 0
-                        new_id = int(cur_max) + 1
-                        new_row = (new_id,) + row[1:]
-                        print(f"✅ INSERT dans {table} depuis {source_path}: {new_row}")
-                        merged_cursor.execute(
-                            f"INSERT INTO {table} ({columns_joined}) VALUES ({placeholders})", new_row
-                        )
-                    else:
-                        print(f"⏩ Doublon ignoré dans {table} depuis {source_path}: {row[1:]}")
+            for source_path in source_db_paths:
+                with sqlite3.connect(source_path) as src_conn:
+                    src_cursor = src_conn.cursor()
+                    try:
+                        src_cursor.execute(f"SELECT * FROM {table}")
+                    except Exception as e:
+                        print(f"⚠️ Erreur lecture de {table} depuis {source_path}: {e}")
+                        continue
 
-    merged_conn.commit()
-    merged_conn.close()
+                    # Lecture par blocs : chaque bloc filtré part directement en executemany
+                    for rows in iter(lambda: src_cursor.fetchmany(1000), []):
+                        to_insert = []
+                        for row in rows:
+                            if len(columns) > 1:
+                                key = tuple(row[1:])
+                                if key in existing:
+                                    logger.debug("Doublon ignoré dans %s depuis %s: %s", table, source_path, row[1:])
+                                    continue
+                                if None not in key:
+                                    existing.add(key)
+                            # Cas spécial : table avec seulement clé primaire -> toujours insérée
+
+                            if auto_id:
+                                new_row = row[1:]
+                            else:
+                                new_row = (next_id,) + row[1:]
+                                next_id += 1
+                            logger.debug("INSERT dans %s depuis %s: %s", table, source_path, new_row)
+                            to_insert.append(new_row)
+
+                        if to_insert:
+                            merged_cursor.executemany(insert_sql, to_insert)
+
+        merged_conn.commit()
+    except Exception:
+        merged_conn.rollback()
+        raise
+    finally:
+        merged_conn.close()
 
 
 def merge_bookmarks(merged_db_path, file1_db, file2_db, location_id_map, bookmark_choices):
     print("\n[FUSION BOOKMARKS AVEC CHOIX UTILISATEUR]", flush=True)
     mapping = {}
-    conn = sqlite3.connect(merged_db_path)
+    conn = sqlite3.connect(merged_db_path, cached_statements=256)
+    apply_merge_pragmas(conn)
+    conn.execute("BEGIN")
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -581,166 +708,222 @@ def merge_bookmarks(merged_db_path, file1_db, file2_db, location_id_map, bookmar
 
     def fetch_bookmarks_as_dict(db_path):
         bookmarks_dict = {}
-        with sqlite3.connect(db_path) as conn_fetch:
-            cur_fetch = conn_fetch.cursor()
-            cur_fetch.execute("SELECT BookmarkId, LocationId, PublicationLocationId, Slot, Title, Snippet, BlockType, BlockIdentifier FROM Bookmark")
-            for row in cur_fetch.fetchall():
-                bookmarks_dict[row[0]] = row
+        cur_fetch = get_conn(db_path).cursor()
+        cur_fetch.execute("SELECT BookmarkId, LocationId, PublicationLocationId, Slot, Title, Snippet, BlockType, BlockIdentifier FROM Bookmark")
+        for row in cur_fetch.fetchall():
+            bookmarks_dict[row[0]] = row
         return bookmarks_dict
 
     bookmarks1_dict = fetch_bookmarks_as_dict(file1_db)
     bookmarks2_dict = fetch_bookmarks_as_dict(file2_db)
 
-    for key, choice_data in bookmark_choices.items():
-        if not isinstance(choice_data, dict):
-            print(f"⚠️ Données de choix inattendues pour l'index '{key}': {choice_data}", flush=True)
-            continue
-
-        choice = choice_data.get("choice", "file1")
-        edited = choice_data.get("edited", {})
-        bookmark_ids = choice_data.get("bookmarkIds", {})
-
-        row1 = bookmarks1_dict.get(bookmark_ids.get("file1"))
-        row2 = bookmarks2_dict.get(bookmark_ids.get("file2"))
-
-        to_insert = []
-        if choice == "file1" and row1:
-            to_insert = [(row1, file1_db)]
-        elif choice == "file2" and row2:
-            to_insert = [(row2, file2_db)]
-        elif choice == "both":
-            if row1: to_insert.append((row1, file1_db))
-            if row2: to_insert.append((row2, file2_db))
-        elif choice == "ignore":
-            print(f"⏩ Bookmark index {key} ignoré par choix utilisateur.", flush=True)
-            continue
-        else:
-            print(f"⚠️ Choix '{choice}' invalide ou bookmark(s) manquant(s) pour index {key}. Ignoré.", flush=True)
-            continue
+    # Mapping normalisé construit une seule fois (et non à chaque bookmark)
+    loc_by_db = mapping_by_db(location_id_map)
+    norm_paths = {file1_db: cached_normpath(file1_db), file2_db: cached_normpath(file2_db)}
 
-        for row, source_db in to_insert:
-            old_id, loc_id, pub_loc_id, slot, title, snippet, block_type, block_id = row
+    # Préchargement unique : mappings déjà faits, bookmarks existants et slots occupés,
+    # pour que tous les tests d'existence de la boucle se fassent en mémoire.
+    cursor.execute("SELECT SourceDb, OldID, NewID FROM MergeMapping_Bookmark")
+    already_mapped = {(src, old): new for src, old, new in cursor.fetchall()}
 
-            source_key = "file1" if os.path.normpath(source_db) == os.path.normpath(file1_db) else "file2"
-            title = edited.get(source_key, {}).get("Title", title)
+    def bookmark_key(loc, pub, slot, title, snippet, block_type, block_id):
+        # Même sémantique que "col = ?" en SQL : une valeur NULL ne correspond jamais
+        if None in (loc, pub, slot, title, block_type):
+            return None
+        return (loc, pub, slot, title, snippet or '', block_type, block_id if block_id is not None else -1)
 
-            norm_map = {(os.path.normpath(k[0]), k[1]): v for k, v in location_id_map.items()}
-            new_loc_id = norm_map.get((os.path.normpath(source_db), loc_id)) if loc_id else None
-            new_pub_loc_id = norm_map.get((os.path.normpath(source_db), pub_loc_id)) if pub_loc_id else None
+    existing_bookmarks = {}
+    used_slots = defaultdict(set)
+    cursor.execute("""
+        SELECT BookmarkId, LocationId, PublicationLocationId, Slot, Title, Snippet, BlockType, BlockIdentifier
+        FROM Bookmark
+        ORDER BY BookmarkId
+    """)
+    for bid, loc, pub, slot, title, snippet, block_type, block_id in cursor.fetchall():
+        bkey = bookmark_key(loc, pub, slot, title, snippet, block_type, block_id)
+        if bkey is not None:
+            existing_bookmarks.setdefault(bkey, bid)
+        used_slots[pub].add(slot)
 
-            if (new_loc_id is None and loc_id is not None) or (new_pub_loc_id is None and pub_loc_id is not None):
-                 print(f"⚠️ LocationId introuvable pour Bookmark OldID {old_id} dans {os.path.basename(source_db)} (LocationId {loc_id} -> {new_loc_id} ou PublicationLocationId {pub_loc_id} -> {new_pub_loc_id}), ignoré.", flush=True)
-                 continue
+    mapping_rows = []
 
-            cursor.execute("""
-                SELECT NewID FROM MergeMapping_Bookmark
-                WHERE SourceDb = ? AND OldID = ?
-            """, (source_db, old_id))
-            res = cursor.fetchone()
-            if res:
-                mapping[(source_db, old_id)] = res[0]
-                print(f"⏩ Bookmark OldID {old_id} de {os.path.basename(source_db)} déjà mappé à NewID {res[0]}", flush=True)
+    try:
+        for key, choice_data in bookmark_choices.items():
+            if not isinstance(choice_data, dict):
+                print(f"⚠️ Données de choix inattendues pour l'index '{key}': {choice_data}", flush=True)
                 continue
 
-            cursor.execute("""
-                SELECT BookmarkId FROM Bookmark
-                WHERE LocationId = ?
-                AND PublicationLocationId = ?
-                AND Slot = ?
-                AND Title = ?
-                AND IFNULL(Snippet, '') = IFNULL(?, '')
-                AND BlockType = ?
-                AND IFNULL(BlockIdentifier, -1) = IFNULL(?, -1)
-            """, (new_loc_id, new_pub_loc_id, slot, title, snippet, block_type, block_id))
-            existing = cursor.fetchone()
-
-            if existing:
-                existing_id = existing[0]
-                print(f"⏩ Bookmark identique trouvé (après édition): OldID {old_id} de {os.path.basename(source_db)} → NewID {existing_id}", flush=True)
-                mapping[(source_db, old_id)] = existing_id
-                cursor.execute("""
-                    INSERT OR IGNORE INTO MergeMapping_Bookmark (SourceDb, OldID, NewID)
-                    VALUES (?, ?, ?)
-                """, (source_db, old_id, existing_id))
+            choice = choice_data.get("choice", "file1")
+            edited = choice_data.get("edited", {})
+            bookmark_ids = choice_data.get("bookmarkIds", {})
+
+            row1 = bookmarks1_dict.get(bookmark_ids.get("file1"))
+            row2 = bookmarks2_dict.get(bookmark_ids.get("file2"))
+
+            # La clé "file1"/"file2" (pour les éditions) est connue dès le choix de la source
+            to_insert = []
+            if choice == "file1" and row1:
+                to_insert = [(row1, file1_db, "file1")]
+            elif choice == "file2" and row2:
+                to_insert = [(row2, file2_db, "file2")]
+            elif choice == "both":
+                if row1: to_insert.append((row1, file1_db, "file1"))
+                if row2: to_insert.append((row2, file2_db, "file2"))
+            elif choice == "ignore":
+                logger.debug("Bookmark index %s ignoré par choix utilisateur.", key)
                 continue
+            else:
+                print(f"⚠️ Choix '{choice}' invalide ou bookmark(s) manquant(s) pour index {key}. Ignoré.", flush=True)
+                continue
+
+            for row, source_db, source_key in to_insert:
+                old_id, loc_id, pub_loc_id, slot, title, snippet, block_type, block_id = row
+
+                norm_source = norm_paths[source_db]
+                title = edited.get(source_key, {}).get("Title", title)
+
+                source_locs = loc_by_db.get(norm_source, {})
+                new_loc_id = source_locs.get(loc_id) if loc_id else None
+                new_pub_loc_id = source_locs.get(pub_loc_id) if pub_loc_id else None
+
+                if (new_loc_id is None and loc_id is not None) or (new_pub_loc_id is None and pub_loc_id is not None):
+                     logger.warning("LocationId introuvable pour Bookmark OldID %s dans %s (LocationId %s -> %s ou PublicationLocationId %s -> %s), ignoré.",
+                                    old_id, cached_basename(source_db), loc_id, new_loc_id, pub_loc_id, new_pub_loc_id)
+                     continue
+
+                res = already_mapped.get((source_db, old_id))
+                if res is not None:
+                    mapping[(source_db, old_id)] = res
+                    logger.debug("Bookmark OldID %s de %s déjà mappé à NewID %s", old_id, source_db, res)
+                    continue
+
+                bkey = bookmark_key(new_loc_id, new_pub_loc_id, slot, title, snippet, block_type, block_id)
+                existing_id = existing_bookmarks.get(bkey) if bkey is not None else None
+
+                if existing_id is not None:
+                    logger.debug("Bookmark identique trouvé (après édition): OldID %s de %s → NewID %s", old_id, source_db, existing_id)
+                    mapping[(source_db, old_id)] = existing_id
+                    already_mapped[(source_db, old_id)] = existing_id
+                    mapping_rows.append((source_db, old_id, existing_id))
+                    continue
+
+                original_slot = slot
+                if new_pub_loc_id is not None:
+                    slots_taken = used_slots[new_pub_loc_id]
+                    while slot in slots_taken:
+                        slot += 1
 
-            original_slot = slot
-            current_slot = slot
-            while True:
+                logger.debug("Insertion Bookmark: OldID %s de %s (slot %s -> %s), PubLocId %s, Title=%r",
+                             old_id, source_db, original_slot, slot, new_pub_loc_id, title)
                 cursor.execute("""
-                    SELECT 1 FROM Bookmark
-                    WHERE PublicationLocationId = ? AND Slot = ?
-                """, (new_pub_loc_id, current_slot))
-                if not cursor.fetchone():
-                    break
-                current_slot += 1
-            slot = current_slot
-
-            print(f"Insertion Bookmark: OldID {old_id} de {os.path.basename(source_db)} (slot {original_slot} -> {slot}), PubLocId {new_pub_loc_id}, Title='{title}'", flush=True)
-            cursor.execute("""
-                INSERT INTO Bookmark
-                (LocationId, PublicationLocationId, Slot, Title,
-                 Snippet, BlockType, BlockIdentifier)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (new_loc_id, new_pub_loc_id, slot, title, snippet, block_type, block_id))
-            new_id = cursor.lastrowid
-            mapping[(source_db, old_id)] = new_id
+                    INSERT INTO Bookmark
+                    (LocationId, PublicationLocationId, Slot, Title,
+                     Snippet, BlockType, BlockIdentifier)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (new_loc_id, new_pub_loc_id, slot, title, snippet, block_type, block_id))
+                new_id = cursor.lastrowid
+                mapping[(source_db, old_id)] = new_id
+                already_mapped[(source_db, old_id)] = new_id
+                mapping_rows.append((source_db, old_id, new_id))
 
-            cursor.execute("""
-                INSERT INTO MergeMapping_Bookmark (SourceDb, OldID, NewID)
-                VALUES (?, ?, ?)
-            """, (source_db, old_id, new_id))
+                used_slots[new_pub_loc_id].add(slot)
+                bkey = bookmark_key(new_loc_id, new_pub_loc_id, slot, title, snippet, block_type, block_id)
+                if bkey is not None:
+                    existing_bookmarks.setdefault(bkey, new_id)
 
-    conn.commit()
-    conn.close()
+        cursor.executemany("""
+            INSERT OR IGNORE INTO MergeMapping_Bookmark (SourceDb, OldID, NewID)
+            VALUES (?, ?, ?)
+        """, mapping_rows)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
     print("✔ Fusion Bookmarks terminée (avec choix utilisateur).", flush=True)
     return mapping
 
 
-def merge_notes(merged_db_path, db1_path, db2_path, location_id_map, usermark_guid_map, note_choices, tag_id_map):
+def merge_notes(merged_db_path, db1_path, db2_path, location_id_map, usermark_guid_map, note_choices, tag_id_map, conn=None):
     print("\n=== DÉBUT DE LA FUSION DES NOTES AVEC CHOIX UTILISATEUR ===", flush=True)
     inserted_count = 0
     note_mapping = {}
 
     def fetch_notes(db_path):
-        notes_data = {}
-        with sqlite3.connect(db_path) as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT n.NoteId, n.Guid, n.UserMarkId, um.UserMarkGuid, n.LocationId,
-                       n.Title, n.Content, n.LastModified, n.Created, n.BlockType, n.BlockIdentifier
-                FROM Note n
-                LEFT JOIN UserMark um ON n.UserMarkId = um.UserMarkId
-            """)
-            for row in cur.fetchall():
-                note_id, guid, usermark_id, usermark_guid, location_id, title, content, lastmod, created, block_type, block_ident = row
-                if usermark_guid is None and usermark_id is not None:
-                    cur2 = conn.cursor()
-                    cur2.execute("SELECT UserMarkGuid FROM UserMark WHERE UserMarkId = ?", (usermark_id,))
-                    result = cur2.fetchone()
-                    usermark_guid = result[0] if result else None
-
-                notes_data[note_id] = {
-                    "NoteId": note_id,
-                    "Guid": guid,
-                    "UserMarkGuid": usermark_guid,
-                    "LocationId": location_id,
-                    "Title": title,
-                    "Content": content,
-                    "LastModified": lastmod,
-                    "Created": created,
-                    "BlockType": block_type,
-                    "BlockIdentifier": block_ident
-                }
-        return notes_data
+        conn = get_conn(db_path)
+        cur = conn.cursor()
+        # sqlite3.Row (sur ce curseur seulement) : accès par nom sans construire un dict par note
+        cur.row_factory = sqlite3.Row
+        cur.execute("""
+            SELECT n.NoteId, n.Guid, n.UserMarkId, um.UserMarkGuid, n.LocationId,
+                   n.Title, n.Content, n.LastModified, n.Created, n.BlockType, n.BlockIdentifier
+            FROM Note n
+            LEFT JOIN UserMark um ON n.UserMarkId = um.UserMarkId
+        """)
+        # Une seule passe : le LEFT JOIN fournit déjà le UserMarkGuid (NULL si le UserMark
+        # n'existe pas, ce qu'une requête de rattrapage par UserMarkId ne changerait pas)
+        return {row[0]: row for row in cur.fetchall()}
 
     notes1_by_id = fetch_notes(db1_path)
     notes2_by_id = fetch_notes(db2_path)
 
-    conn = sqlite3.connect(merged_db_path)
+    # Invariants de boucle : mapping des Location normalisé une seule fois
+    loc_by_db = mapping_by_db(location_id_map)
+    db1_norm = cached_normpath(db1_path)
+    db2_norm = cached_normpath(db2_path)
+
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
+    # Index Guid -> NoteId de la base fusionnée, chargé une fois et tenu à jour à chaque insertion
+    cursor.execute("SELECT Guid, NoteId FROM Note")
+    guid_index = {guid: note_id for guid, note_id in cursor.fetchall()}
+    last_note_id = max(guid_index.values(), default=0)
+
+    # Insertions regroupées par lots (executemany) dans une seule transaction.
+    # Le mapping ancien ID -> nouvel ID est résolu par Guid après chaque lot.
+    insert_note_sql = """
+        INSERT INTO Note
+          (Guid, UserMarkId, LocationId, Title, Content,
+           LastModified, Created, BlockType, BlockIdentifier)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    pending_inserts = []
+    pending_guids = set()
+    mapping_by_guid = []
+
+    def flush_pending_notes():
+        nonlocal last_note_id, inserted_count
+        if not pending_inserts:
+            return
+        cursor.execute("SAVEPOINT note_batch")
+        try:
+            cursor.executemany(insert_note_sql, pending_inserts)
+            cursor.execute("RELEASE note_batch")
+        except sqlite3.IntegrityError as ie:
+            # Un lot en échec est rejoué ligne par ligne pour n'écarter que la note fautive
+            cursor.execute("ROLLBACK TO note_batch")
+            cursor.execute("RELEASE note_batch")
+            logger.warning("Erreur d'intégrité dans un lot de notes (%s), insertion ligne par ligne", ie)
+            for params in pending_inserts:
+                try:
+                    cursor.execute(insert_note_sql, params)
+                except sqlite3.IntegrityError as row_error:
+                    logger.warning("Échec d'insertion de la note GUID %s : %s", params[0], row_error)
+
+        cursor.execute("SELECT Guid, NoteId FROM Note WHERE NoteId > ?", (last_note_id,))
+        for guid, note_id in cursor.fetchall():
+            guid_index[guid] = note_id
+            last_note_id = max(last_note_id, note_id)
+            inserted_count += 1
+        pending_inserts.clear()
+        pending_guids.clear()
+
     processed_guids = set()
+    conn.execute("BEGIN")
 
     for frontend_index_str in sorted(note_choices.keys(), key=int):
         choice_data = note_choices[frontend_index_str]
@@ -749,32 +932,33 @@ def merge_notes(merged_db_path, db1_path, db2_path, location_id_map, usermark_gu
         original_note_ids = choice_data.get("noteIds", {})
 
         if choice == "ignore":
-            print(f"⏩ Note frontend index {frontend_index_str} ignorée par choix utilisateur.", flush=True)
+            logger.debug("Note frontend index %s ignorée par choix utilisateur.", frontend_index_str)
             continue
 
-        merged_note_data = {}
+        merged_note_data = None
         source_db_for_mapping = None
         old_note_id_for_mapping = None
 
-        if choice == "file1" or (choice == "both" and original_note_ids.get("file1") is not None and original_note_ids[
-            "file1"] in notes1_by_id):
-            old_id = original_note_ids["file1"]
-            merged_note_data = dict(notes1_by_id[old_id])
+        # Une seule recherche par fichier (.get) au lieu de "in" puis indexation
+        old_id_f1 = original_note_ids.get("file1")
+        old_id_f2 = original_note_ids.get("file2")
+        note_f1 = notes1_by_id.get(old_id_f1) if old_id_f1 is not None else None
+        note_f2 = notes2_by_id.get(old_id_f2) if old_id_f2 is not None else None
+
+        # La ligne source est lue telle quelle (pas de copie) ; seuls Title/Content peuvent être édités
+        if choice in ("file1", "both") and note_f1 is not None:
+            merged_note_data = note_f1
             source_db_for_mapping = db1_path
-            old_note_id_for_mapping = old_id
+            old_note_id_for_mapping = old_id_f1
 
-        if not merged_note_data and (choice == "file2" or (
-                choice == "both" and original_note_ids.get("file2") is not None and original_note_ids[
-            "file2"] in notes2_by_id)):
-            old_id = original_note_ids["file2"]
-            merged_note_data = dict(notes2_by_id[old_id])
+        if merged_note_data is None and choice in ("file2", "both") and note_f2 is not None:
+            merged_note_data = note_f2
             source_db_for_mapping = db2_path
-            old_note_id_for_mapping = old_id
+            old_note_id_for_mapping = old_id_f2
 
-        if not merged_note_data:
-            print(
-                f"⚠️ Choix '{choice}' pour index {frontend_index_str} mais aucune note source valide trouvée. Ignoré.",
-                flush=True)
+        if merged_note_data is None:
+            logger.warning("Choix '%s' pour index %s mais aucune note source valide trouvée. Ignoré.",
+                           choice, frontend_index_str)
             continue
 
         edited_file_key = None
@@ -783,119 +967,102 @@ def merge_notes(merged_db_path, db1_path, db2_path, location_id_map, usermark_gu
         elif "file2" in edited_data and edited_data["file2"]:
             edited_file_key = "file2"
 
+        note_title = merged_note_data["Title"]
+        note_content = merged_note_data["Content"]
         if edited_file_key:
             if "Title" in edited_data[edited_file_key]:
-                merged_note_data["Title"] = edited_data[edited_file_key]["Title"]
+                note_title = edited_data[edited_file_key]["Title"]
             if "Content" in edited_data[edited_file_key]:
-                merged_note_data["Content"] = edited_data[edited_file_key]["Content"]
+                note_content = edited_data[edited_file_key]["Content"]
 
         new_loc = None
         if merged_note_data["LocationId"]:
-            norm_map = {(os.path.normpath(k[0]), k[1]): v for k, v in location_id_map.items()}
-
             original_source_db = None
+            original_source_norm = None
             if old_note_id_for_mapping == original_note_ids.get("file1") and original_note_ids.get("file1") is not None:
                 original_source_db = db1_path
+                original_source_norm = db1_norm
             elif old_note_id_for_mapping == original_note_ids.get("file2") and original_note_ids.get(
                     "file2") is not None:
                 original_source_db = db2_path
+                original_source_norm = db2_norm
 
             if original_source_db:
-                new_loc = norm_map.get((os.path.normpath(original_source_db), merged_note_data["LocationId"]))
+                new_loc = loc_by_db.get(original_source_norm, {}).get(merged_note_data["LocationId"])
 
         if new_loc is None and merged_note_data["LocationId"] is not None:
-            print(
-                f"⚠️ LocationId {merged_note_data['LocationId']} pour la note {merged_note_data['NoteId']} depuis la source {original_source_db if original_source_db else 'inconnue'} n'a pas été mappé. La note pourrait être insérée sans emplacement correct.",
-                flush=True)
+            logger.warning("LocationId %s pour la note %s depuis la source %s n'a pas été mappé. "
+                           "La note pourrait être insérée sans emplacement correct.",
+                           merged_note_data['LocationId'], merged_note_data['NoteId'],
+                           original_source_db if original_source_db else 'inconnue')
 
         new_um = usermark_guid_map.get(merged_note_data["UserMarkGuid"]) if merged_note_data["UserMarkGuid"] else None
 
-        existing_in_merged_db_id = None
+        mapping_key = None
+        if old_note_id_for_mapping and source_db_for_mapping:
+            # Clé au chemin normalisé, comme l'attendent merge_tags_and_tagmap et apply_selected_tags
+            mapping_key = (cached_normpath(source_db_for_mapping), old_note_id_for_mapping)
+
         if merged_note_data["Guid"]:
-            cursor.execute("SELECT NoteId FROM Note WHERE Guid = ?", (merged_note_data["Guid"],))
-            existing_in_merged_db_id = cursor.fetchone()
-            if existing_in_merged_db_id:
-                existing_in_merged_db_id = existing_in_merged_db_id[0]
-                if merged_note_data["Guid"] in processed_guids:
-                    print(
-                        f"⏩ Note avec GUID {merged_note_data['Guid']} (index frontend {frontend_index_str}) déjà traitée et mappée. Ignorée.",
-                        flush=True)
-                    if old_note_id_for_mapping and source_db_for_mapping:
-                        note_mapping[(source_db_for_mapping, old_note_id_for_mapping)] = existing_in_merged_db_id
-                    continue
+            guid = merged_note_data["Guid"]
+            if guid in guid_index or guid in pending_guids:
+                if guid in processed_guids:
+                    logger.debug("Note avec GUID %s (index frontend %s) déjà traitée et mappée. Ignorée.",
+                                 guid, frontend_index_str)
                 else:
-                    print(
-                        f"⏩ Note avec GUID {merged_note_data['Guid']} existe déjà dans la base de données fusionnée (NoteId: {existing_in_merged_db_id}). Mappage de l'ancien ID vers l'ID fusionné existant.",
-                        flush=True)
-                    if old_note_id_for_mapping and source_db_for_mapping:
-                        note_mapping[(source_db_for_mapping, old_note_id_for_mapping)] = existing_in_merged_db_id
-                    processed_guids.add(merged_note_data["Guid"])
-                    continue
+                    logger.debug("Note avec GUID %s existe déjà dans la base fusionnée. "
+                                 "Mappage de l'ancien ID vers l'ID fusionné existant.", guid)
+                    processed_guids.add(guid)
+                if mapping_key:
+                    mapping_by_guid.append((mapping_key, guid))
+                continue
 
         final_guid_to_insert = merged_note_data["Guid"]
         if not final_guid_to_insert:
             final_guid_to_insert = str(uuid.uuid4())
-            print(f"Nouveau GUID généré pour la note (pas de GUID d'origine): {final_guid_to_insert}", flush=True)
+            logger.debug("Nouveau GUID généré pour la note (pas de GUID d'origine): %s", final_guid_to_insert)
         elif final_guid_to_insert in processed_guids:
-            print(
-                f"⚠️ GUID {final_guid_to_insert} déjà dans l'ensemble traité. Saut de la ré-insertion pour l'index frontend {frontend_index_str}.",
-                flush=True)
+            logger.debug("GUID %s déjà dans l'ensemble traité. Saut de la ré-insertion pour l'index frontend %s.",
+                         final_guid_to_insert, frontend_index_str)
             continue
 
-        try:
-            cursor.execute("""
-                INSERT INTO Note
-                  (Guid, UserMarkId, LocationId, Title, Content,
-                   LastModified, Created, BlockType, BlockIdentifier)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (final_guid_to_insert, new_um, new_loc,
-                  merged_note_data["Title"], merged_note_data["Content"],
-                  merged_note_data["LastModified"], merged_note_data["Created"],
-                  merged_note_data["BlockType"], merged_note_data["BlockIdentifier"]))
-
-            new_note_id = cursor.lastrowid
-
-            if old_note_id_for_mapping and source_db_for_mapping:
-                note_mapping[(source_db_for_mapping, old_note_id_for_mapping)] = new_note_id
-
-            processed_guids.add(final_guid_to_insert)
-            inserted_count += 1
-            print(
-                f"✅ Note insérée (index frontend {frontend_index_str}): Nouvel ID {new_note_id} (GUID: {final_guid_to_insert})",
-                flush=True)
-
-        except sqlite3.IntegrityError as ie:
-            print(
-                f"❌ Erreur d'intégrité lors de l'insertion de la note (index frontend {frontend_index_str}, GUID {final_guid_to_insert}): {ie}",
-                flush=True)
-            cursor.execute("SELECT NoteId FROM Note WHERE Guid = ?", (final_guid_to_insert,))
-            existing_after_error = cursor.fetchone()
-            if existing_after_error:
-                if old_note_id_for_mapping and source_db_for_mapping:
-                    note_mapping[(source_db_for_mapping, old_note_id_for_mapping)] = existing_after_error[0]
-                processed_guids.add(final_guid_to_insert)
-                print(
-                    f"⏩ Récupération de l'ID existant {existing_after_error[0]} suite à un échec d'insertion (GUID {final_guid_to_insert})",
-                    flush=True)
-            else:
-                print(f"⚠️ Échec critique d'insertion/récupération pour la note {frontend_index_str}. Saut.",
-                      flush=True)
-                continue
+        pending_inserts.append((final_guid_to_insert, new_um, new_loc,
+                                note_title, note_content,
+                                merged_note_data["LastModified"], merged_note_data["Created"],
+                                merged_note_data["BlockType"], merged_note_data["BlockIdentifier"]))
+        pending_guids.add(final_guid_to_insert)
+        processed_guids.add(final_guid_to_insert)
+        if mapping_key:
+            mapping_by_guid.append((mapping_key, final_guid_to_insert))
+        logger.debug("Note préparée pour insertion (index frontend %s, GUID: %s)",
+                     frontend_index_str, final_guid_to_insert)
+
+        if len(pending_inserts) >= 1000:
+            flush_pending_notes()
+
+    flush_pending_notes()
+
+    for mapping_key, guid in mapping_by_guid:
+        new_note_id = guid_index.get(guid)
+        if new_note_id is None:
+            logger.warning("Note GUID %s non insérée, pas de mapping pour %s", guid, mapping_key)
+            continue
+        note_mapping[mapping_key] = new_note_id
 
     conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
     print(f"✅ Total notes insérées : {inserted_count}", flush=True)
     return note_mapping
 
 
-def merge_usermark_with_id_relabeling(merged_db_path, source_db_path, location_id_map):
-    conn_merged = sqlite3.connect(merged_db_path)
+def merge_usermark_with_id_relabeling(merged_db_path, source_db_path, location_id_map, conn=None):
+    conn_merged = open_merged_db(merged_db_path, conn)
     cur_merged = conn_merged.cursor()
 
-    # Récupère les IDs existants pour éviter les conflits
-    cur_merged.execute("SELECT UserMarkId FROM UserMark")
-    existing_ids = set(row[0] for row in cur_merged.fetchall())
-    current_max_id = max(existing_ids) if existing_ids else 0
+    # Seul le plus grand ID existant est nécessaire : les nouveaux IDs sont attribués au-delà
+    cur_merged.execute("SELECT COALESCE(MAX(UserMarkId), 0) FROM UserMark")
+    current_max_id = initial_max_id = cur_merged.fetchone()[0]
 
     # Charge les données source
     conn_source = sqlite3.connect(source_db_path)
@@ -904,50 +1071,61 @@ def merge_usermark_with_id_relabeling(merged_db_path, source_db_path, location_i
     source_rows = cur_source.fetchall()
     conn_source.close()
 
-    # Création du mapping UserMarkId (si conflits)
-    replacements = {}
-    for row in source_rows:
-        old_id = row[0]
-        if old_id in existing_ids:
-            current_max_id += 1
-            new_id = current_max_id
-            replacements[old_id] = new_id
-        else:
-            replacements[old_id] = old_id
-            existing_ids.add(old_id)
-
-    # Insertion dans la base fusionnée avec LocationId mappé
+    # IDs candidats : chaque ligne source reçoit un ID après MAX(UserMarkId), ce qui exclut tout
+    # conflit d'ID sans charger les IDs existants ; les doublons de GUID sont écartés à l'insertion
+    # (comme dans merge_usermark_from_sources)
+    candidate_ids = {}
     for row in source_rows:
-        old_id = row[0]
-        new_id = replacements[old_id]
-        ColorIndex = row[1]
-        LocationId = row[2]
-        StyleIndex = row[3]
-        UserMarkGuid = row[4]
-        Version = row[5]
-
-        # Mapping du LocationId
-        mapped_loc_id = location_id_map.get((source_db_path, LocationId), LocationId)
-
-        try:
-            cur_merged.execute("""
-                INSERT INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (new_id, ColorIndex, mapped_loc_id, StyleIndex, UserMarkGuid, Version))
-        except Exception as e:
-            print(f"Erreur insertion UserMark old_id={old_id}, new_id={new_id}: {e}")
+        current_max_id += 1
+        candidate_ids[row[0]] = current_max_id
+
+    # Insertion dans la base fusionnée avec LocationId mappé, en un seul executemany.
+    # OR IGNORE écarte les lignes en conflit (GUID déjà présent...) comme le faisait le try/except par ligne.
+    batch = [
+        (candidate_ids[old_id], color, location_id_map.get((source_db_path, loc_id), loc_id), style, guid, version)
+        for old_id, color, loc_id, style, guid, version in source_rows
+    ]
+    conn_merged.execute("BEGIN")
+    cur_merged.executemany("""
+        INSERT OR IGNORE INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, batch)
+    skipped = len(batch) - cur_merged.rowcount
+    if skipped:
+        logger.debug("UserMark : %s ligne(s) ignorée(s), GUID déjà présent", skipped)
+
+    # Les lignes insérées gardent leur ID candidat ; seules les lignes ignorées (GUID déjà présent
+    # avant l'insertion, donc UserMarkId <= initial_max_id) sont résolues vers la ligne existante,
+    # par paquets de GUID sources (UserMarkGuid est UNIQUE, donc indexé)
+    existing_by_guid = {}
+    if skipped:
+        source_guids = [row[4] for row in source_rows]
+        for i in range(0, len(source_guids), 500):
+            chunk = source_guids[i:i + 500]
+            placeholders = ",".join("?" for _ in chunk)
+            cur_merged.execute(f"""
+                SELECT UserMarkGuid, UserMarkId FROM UserMark
+                WHERE UserMarkId <= ? AND UserMarkGuid IN ({placeholders})
+            """, (initial_max_id, *chunk))
+            existing_by_guid.update(cur_merged.fetchall())
+    replacements = {
+        old_id: existing_by_guid.get(guid, candidate_ids[old_id])
+        for old_id, _, _, _, guid, _ in source_rows
+    }
 
     conn_merged.commit()
-    conn_merged.close()
+    if conn is None:
+        conn_merged.close()
     return replacements
 
 
-def merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db):
+def merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db, conn=None):
     print("\n=== FUSION BLOCKRANGE ===")
 
     try:
-        with sqlite3.connect(merged_db_path) as dest_conn:
-            dest_conn.execute("PRAGMA busy_timeout = 10000")
+        with open_merged_db(merged_db_path, conn) as dest_conn:
+            # Verrou d'écriture pris dès le départ pour toute la fusion BlockRange
+            dest_conn.execute("BEGIN IMMEDIATE")
             dest_cursor = dest_conn.cursor()
 
             # 1) Vérification initiale
@@ -959,6 +1137,12 @@ def merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db):
             usermark_guid_map = {guid: uid for uid, guid in dest_cursor.fetchall()}
             print(f"UserMark GUIDs: {usermark_guid_map}")
 
+            # Clés déjà présentes chargées une fois ; une clé contenant NULL ne correspond
+            # jamais (même logique que la comparaison "col=?" faite auparavant en SQL)
+            dest_cursor.execute("SELECT BlockType, Identifier, UserMarkId, StartToken, EndToken FROM BlockRange")
+            existing_keys = {key for key in dest_cursor.fetchall() if None not in key}
+            to_insert = []
+
             # 3) Traitement des sources
             for db_path in [file1_db, file2_db]:
                 print(f"\nTraitement de {db_path}")
@@ -981,36 +1165,32 @@ def merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db):
                                 print(f"⚠️ GUID non mappé: {usermark_guid}")
                                 continue
 
-                            try:
-                                dest_cursor.execute("""
-                                    SELECT 1 FROM BlockRange
-                                    WHERE BlockType=? AND Identifier=? AND UserMarkId=?
-                                    AND StartToken=? AND EndToken=?
-                                """, (block_type, identifier, new_usermark_id, start_token, end_token))
-
-                                if dest_cursor.fetchone():
-                                    print(f"⏩ Existe déjà: {row}")
-                                    continue
-
-                                dest_cursor.execute("""
-                                    INSERT INTO BlockRange
-                                    (BlockType, Identifier, StartToken, EndToken, UserMarkId)
-                                    VALUES (?, ?, ?, ?, ?)
-                                """, (block_type, identifier, start_token, end_token, new_usermark_id))
-
-                                print(f"✅ Inserté: {row}")
+                            key = (block_type, identifier, new_usermark_id, start_token, end_token)
+                            if key in existing_keys:
+                                logger.debug("BlockRange existe déjà: %s", row)
+                                continue
+                            if None not in key:
+                                existing_keys.add(key)
 
-                            except sqlite3.IntegrityError as e:
-                                print(f"❌ Erreur intégrité: {e}")
-                                print(f"Ligne problématique: {row}")
-                                dest_cursor.execute("PRAGMA foreign_key_check")
-                                print("Problèmes clés étrangères:", dest_cursor.fetchall())
-                                return False
+                            to_insert.append((block_type, identifier, start_token, end_token, new_usermark_id))
 
                 except Exception as e:
                     print(f"❌ Erreur lors du traitement de {db_path}: {e}")
                     return False
 
+            try:
+                dest_cursor.executemany("""
+                    INSERT INTO BlockRange
+                    (BlockType, Identifier, StartToken, EndToken, UserMarkId)
+                    VALUES (?, ?, ?, ?, ?)
+                """, to_insert)
+                print(f"✅ BlockRanges insérés: {len(to_insert)}")
+            except sqlite3.IntegrityError as e:
+                print(f"❌ Erreur intégrité: {e}")
+                dest_cursor.execute("PRAGMA foreign_key_check")
+                print("Problèmes clés étrangères:", dest_cursor.fetchall())
+                return False
+
             # ✅ Après avoir traité les deux fichiers, on fait 1 seul commit
             try:
                 dest_conn.commit()
@@ -1026,7 +1206,7 @@ def merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db):
     return True
 
 
-def merge_inputfields(merged_db_path, file1_db, file2_db, location_id_map):
+def merge_inputfields(merged_db_path, file1_db, file2_db, location_id_map, conn=None):
     print("\n[FUSION ET REMAPPAGE DES INPUTFIELD]", flush=True)
     inserted_count = 0
     missing_loc_count = 0
@@ -1053,136 +1233,161 @@ def merge_inputfields(merged_db_path, file1_db, file2_db, location_id_map):
     except Exception as e:
         print(f"⚠️ Erreur lors de la lecture des InputField depuis {os.path.basename(file2_db)}: {e}", flush=True)
 
-    with sqlite3.connect(merged_db_path) as conn:
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
+    try:
         cursor = conn.cursor()
 
         # Nettoyage initial : supprime toutes les entrées InputField existantes dans la DB fusionnée.
         # Cela assure une réinsertion propre basée sur les données des fichiers source.
+        # Suppression et réinsertion se font dans la même transaction.
         print("🧹 Suppression des InputField existants dans la base fusionnée...", flush=True)
+        conn.execute("BEGIN")
         cursor.execute("DELETE FROM InputField")
-        conn.commit()
 
         # Réinsertion des InputField en appliquant le remappage
+        loc_by_db = mapping_by_db(location_id_map)
+        inputfields_to_insert = []
         for source_db_path, old_loc_id, text_tag, value in all_inputfields_to_process:
-            normalized_source_db_path = os.path.normpath(source_db_path)
-            new_loc_id = location_id_map.get((normalized_source_db_path, old_loc_id))
+            new_loc_id = loc_by_db.get(cached_normpath(source_db_path), {}).get(old_loc_id)
 
             if new_loc_id is None:
-                print(f"❌ LocationId {old_loc_id} (provenant de {os.path.basename(source_db_path)}) non mappé. InputField '{text_tag}' ignoré.", flush=True)
+                print(f"❌ LocationId {old_loc_id} (provenant de {cached_basename(source_db_path)}) non mappé. InputField '{text_tag}' ignoré.", flush=True)
                 missing_loc_count += 1
                 continue
 
-            try:
-                # Utiliser INSERT OR REPLACE pour gérer les doublons potentiels
-                # (même LocationId et TextTag) en écrasant l'ancienne valeur.
-                cursor.execute("""
-                    INSERT OR REPLACE INTO InputField (LocationId, TextTag, Value)
-                    VALUES (?, ?, ?)
-                """, (new_loc_id, text_tag, value))
-                inserted_count += 1
-            except sqlite3.Error as e:
-                print(f"❌ Erreur lors de l'insertion ou du remplacement d'InputField (LocId={new_loc_id}, TextTag='{text_tag}'): {e}", flush=True)
+            inputfields_to_insert.append((new_loc_id, text_tag, value))
+
+        try:
+            # Utiliser INSERT OR REPLACE pour gérer les doublons potentiels
+            # (même LocationId et TextTag) en écrasant l'ancienne valeur.
+            cursor.executemany("""
+                INSERT OR REPLACE INTO InputField (LocationId, TextTag, Value)
+                VALUES (?, ?, ?)
+            """, inputfields_to_insert)
+            inserted_count = len(inputfields_to_insert)
+        except sqlite3.Error as e:
+            print(f"❌ Erreur lors de l'insertion ou du remplacement des InputField: {e}", flush=True)
 
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if not shared_conn:
+            conn.close()
 
     print("\n=== RÉSUMÉ FUSION INPUTFIELD ===", flush=True)
     print(f"✅ InputField insérés/mis à jour : {inserted_count}", flush=True)
     print(f"❌ InputField ignorés (LocationId non mappés) : {missing_loc_count}", flush=True)
 
 
-def update_location_references(merged_db_path, location_replacements):
-    conn = sqlite3.connect(merged_db_path)
+def update_location_references(merged_db_path, location_replacements, conn=None):
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
+    conn.execute("BEGIN IMMEDIATE")
     cursor = conn.cursor()
 
     print("\n[MISE À JOUR DES RÉFÉRENCES DE LOCALISATION]", flush=True)
 
-    for old_loc, new_loc in location_replacements.items():
-        if old_loc == new_loc:
-            continue # Aucune mise à jour nécessaire si l'ID ne change pas
-
-        # Mise à jour Bookmark.LocationId
-        try:
-            cursor.execute("UPDATE Bookmark SET LocationId = ? WHERE LocationId = ?", (new_loc, old_loc))
-            if cursor.rowcount > 0:
-                print(f"  Bookmark.LocationId mis à jour: {old_loc} -> {new_loc} ({cursor.rowcount} lignes)", flush=True)
-        except sqlite3.Error as e:
-            print(f"  ❌ Erreur mise à jour Bookmark.LocationId {old_loc} -> {new_loc}: {e}", flush=True)
-
-        # Mise à jour Bookmark.PublicationLocationId avec gestion des conflits de Slot
-        try:
-            cursor.execute("""
-                SELECT BookmarkId, Slot FROM Bookmark
-                WHERE PublicationLocationId = ?
-            """, (old_loc,))
-            rows = cursor.fetchall()
-
-            for bookmark_id, slot in rows:
-                cursor.execute("""
-                    SELECT 1 FROM Bookmark
-                    WHERE PublicationLocationId = ? AND Slot = ? AND BookmarkId != ?
-                """, (new_loc, slot, bookmark_id))
-                conflict = cursor.fetchone()
-
-                if conflict:
-                    print(f"  ⚠️ Mise à jour ignorée pour Bookmark ID {bookmark_id} (conflit de Slot avec PublicationLocationId={new_loc})", flush=True)
-                else:
-                    cursor.execute("""
-                        UPDATE Bookmark
-                        SET PublicationLocationId = ?
-                        WHERE BookmarkId = ? AND PublicationLocationId = ?
-                    """, (new_loc, bookmark_id, old_loc))
-                    if cursor.rowcount > 0:
-                        print(f"  Bookmark.PublicationLocationId mis à jour: {old_loc} -> {new_loc} (BookmarkId {bookmark_id})", flush=True)
-        except sqlite3.Error as e:
-            print(f"  ❌ Erreur mise à jour sécurisée Bookmark.PublicationLocationId {old_loc} -> {new_loc}: {e}", flush=True)
-
-        # Mise à jour PlaylistItemLocationMap sécurisée
-        try:
-            # Récupérer les PlaylistItemId qui sont liés à l'ancien LocationId
-            cursor.execute("""
-                SELECT PlaylistItemId FROM PlaylistItemLocationMap
-                WHERE LocationId = ?
-            """, (old_loc,))
-            playlist_item_ids_to_update = [row[0] for row in cursor.fetchall()]
+    # Table temporaire old -> new : chaque table cible est mise à jour en une seule requête.
+    # Les remplacements sont appliqués simultanément (pas d'enchaînement a -> b -> c).
+    cursor.execute("DROP TABLE IF EXISTS temp.LocationReplacement")
+    cursor.execute("CREATE TEMP TABLE LocationReplacement (OldId INTEGER PRIMARY KEY, NewId INTEGER NOT NULL)")
+    cursor.executemany(
+        "INSERT INTO temp.LocationReplacement (OldId, NewId) VALUES (?, ?)",
+        [(old_loc, new_loc) for old_loc, new_loc in location_replacements.items() if old_loc != new_loc]
+    )
 
-            for playlist_item_id in playlist_item_ids_to_update:
-                # Vérifier s'il existe déjà une entrée avec le même PlaylistItemId et le nouveau LocationId
-                cursor.execute("""
-                    SELECT 1 FROM PlaylistItemLocationMap
-                    WHERE PlaylistItemId = ? AND LocationId = ?
-                """, (playlist_item_id, new_loc))
-                conflict_entry = cursor.fetchone()
+    # Mise à jour Bookmark.LocationId
+    try:
+        cursor.execute("""
+            UPDATE Bookmark
+            SET LocationId = (SELECT r.NewId FROM temp.LocationReplacement r WHERE r.OldId = Bookmark.LocationId)
+            WHERE LocationId IN (SELECT OldId FROM temp.LocationReplacement)
+        """)
+        print(f"  Bookmark.LocationId mis à jour ({cursor.rowcount} lignes)", flush=True)
+    except sqlite3.Error as e:
+        print(f"  ❌ Erreur mise à jour Bookmark.LocationId: {e}", flush=True)
 
-                if conflict_entry:
-                    # Si un conflit existe, et l'ancienne entrée est toujours là, la supprimer
-                    cursor.execute("""
-                        DELETE FROM PlaylistItemLocationMap
-                        WHERE PlaylistItemId = ? AND LocationId = ?
-                    """, (playlist_item_id, old_loc))
-                    if cursor.rowcount > 0:
-                        print(f"  ⚠️ Conflit dans PlaylistItemLocationMap: Entrée existante (ItemId={playlist_item_id}, LocationId={new_loc}). Ancienne entrée {old_loc} supprimée.", flush=True)
-                else:
-                    # S'il n'y a pas de conflit, mettre à jour l'entrée
-                    cursor.execute("""
-                        UPDATE PlaylistItemLocationMap
-                        SET LocationId = ?
-                        WHERE PlaylistItemId = ? AND LocationId = ?
-                    """, (new_loc, playlist_item_id, old_loc))
-                    if cursor.rowcount > 0:
-                        print(f"  PlaylistItemLocationMap mis à jour: ItemId={playlist_item_id}, LocationId {old_loc} -> {new_loc}", flush=True)
-        except sqlite3.Error as e:
-            print(f"  ❌ Erreur mise à jour PlaylistItemLocationMap pour {old_loc} -> {new_loc}: {e}", flush=True)
+    # Mise à jour Bookmark.PublicationLocationId : OR IGNORE saute les bookmarks
+    # dont le Slot est déjà pris sur le nouveau PublicationLocationId
+    try:
+        cursor.execute("SELECT COUNT(*) FROM Bookmark WHERE PublicationLocationId IN (SELECT OldId FROM temp.LocationReplacement)")
+        candidates = cursor.fetchone()[0]
+        cursor.execute("""
+            UPDATE OR IGNORE Bookmark
+            SET PublicationLocationId = (
+                SELECT r.NewId FROM temp.LocationReplacement r WHERE r.OldId = Bookmark.PublicationLocationId
+            )
+            WHERE PublicationLocationId IN (SELECT OldId FROM temp.LocationReplacement)
+        """)
+        print(f"  Bookmark.PublicationLocationId mis à jour ({cursor.rowcount} lignes)", flush=True)
+        if candidates > cursor.rowcount:
+            print(f"  ⚠️ {candidates - cursor.rowcount} Bookmark(s) non mis à jour (conflit de Slot)", flush=True)
+    except sqlite3.Error as e:
+        print(f"  ❌ Erreur mise à jour sécurisée Bookmark.PublicationLocationId: {e}", flush=True)
+
+    # Mise à jour PlaylistItemLocationMap sécurisée :
+    # l'ancienne entrée est supprimée si (PlaylistItemId, nouveau LocationId) existe déjà
+    # ou sera déjà produite par une autre entrée, sinon mise à jour
+    try:
+        cursor.execute("""
+            DELETE FROM PlaylistItemLocationMap
+            WHERE LocationId IN (SELECT OldId FROM temp.LocationReplacement)
+              AND EXISTS (
+                  SELECT 1
+                  FROM PlaylistItemLocationMap p2
+                  JOIN temp.LocationReplacement r ON r.OldId = PlaylistItemLocationMap.LocationId
+                  WHERE p2.PlaylistItemId = PlaylistItemLocationMap.PlaylistItemId
+                    AND p2.LocationId = r.NewId
+              )
+        """)
+        conflicts = cursor.rowcount
+        # Plusieurs anciens LocationId d'un même PlaylistItemId qui pointent vers le même nouveau :
+        # on ne garde que le plus petit, les autres entrées sont supprimées (sinon l'UPDATE OR IGNORE
+        # les laisserait sur leur ancien LocationId)
+        cursor.execute("""
+            DELETE FROM PlaylistItemLocationMap
+            WHERE LocationId IN (SELECT OldId FROM temp.LocationReplacement)
+              AND EXISTS (
+                  SELECT 1
+                  FROM PlaylistItemLocationMap p2
+                  JOIN temp.LocationReplacement r2 ON r2.OldId = p2.LocationId
+                  JOIN temp.LocationReplacement r1 ON r1.OldId = PlaylistItemLocationMap.LocationId
+                  WHERE p2.PlaylistItemId = PlaylistItemLocationMap.PlaylistItemId
+                    AND r2.NewId = r1.NewId
+                    AND p2.LocationId < PlaylistItemLocationMap.LocationId
+              )
+        """)
+        conflicts += cursor.rowcount
+        if conflicts > 0:
+            print(f"  ⚠️ Conflits dans PlaylistItemLocationMap: {conflicts} ancienne(s) entrée(s) supprimée(s)", flush=True)
+        cursor.execute("""
+            UPDATE OR IGNORE PlaylistItemLocationMap
+            SET LocationId = (
+                SELECT r.NewId FROM temp.LocationReplacement r WHERE r.OldId = PlaylistItemLocationMap.LocationId
+            )
+            WHERE LocationId IN (SELECT OldId FROM temp.LocationReplacement)
+        """)
+        print(f"  PlaylistItemLocationMap mis à jour ({cursor.rowcount} lignes)", flush=True)
+    except sqlite3.Error as e:
+        print(f"  ❌ Erreur mise à jour PlaylistItemLocationMap: {e}", flush=True)
 
+    cursor.execute("DROP TABLE IF EXISTS temp.LocationReplacement")
     conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
     print("✔ Mise à jour des références de localisation terminée.", flush=True)
 
 
-def merge_usermark_from_sources(merged_db_path, file1_db, file2_db, location_id_map):
+def merge_usermark_from_sources(merged_db_path, file1_db, file2_db, location_id_map, conn=None):
     print("\n[FUSION USERMARK - IDÉMPOTENTE]")
     mapping = {}
 
-    conn = sqlite3.connect(merged_db_path)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
+    conn.execute("BEGIN")
     cursor = conn.cursor()
 
     # Créer la table de mapping
@@ -1199,7 +1404,17 @@ def merge_usermark_from_sources(merged_db_path, file1_db, file2_db, location_id_
     cursor.execute("SELECT COALESCE(MAX(UserMarkId), 0) FROM UserMark")
     max_id = cursor.fetchone()[0]
 
+    # Mappings déjà faits et UserMark existants (par GUID) chargés une seule fois,
+    # puis tenus à jour au fil des deux sources
+    cursor.execute("SELECT SourceDb, OldUserMarkId, NewUserMarkId FROM MergeMapping_UserMark")
+    existing_mapping = {(src, old): new for src, old, new in cursor.fetchall()}
+    cursor.execute("SELECT UserMarkGuid, UserMarkId, ColorIndex, LocationId, StyleIndex, Version FROM UserMark")
+    usermark_by_guid = {g: (uid, c, loc, st, v) for g, uid, c, loc, st, v in cursor.fetchall()}
+
     for db_path in [file1_db, file2_db]:
+        # Insertions regroupées par source puis envoyées en executemany
+        usermarks_to_insert = []
+        mappings_to_insert = []
         with sqlite3.connect(db_path) as src_conn:
             src_cursor = src_conn.cursor()
             src_cursor.execute("""
@@ -1210,25 +1425,17 @@ def merge_usermark_from_sources(merged_db_path, file1_db, file2_db, location_id_
 
             for old_um_id, color, loc_id, style, guid, version in rows:
                 # Vérifier si déjà mappé
-                cursor.execute("""
-                    SELECT NewUserMarkId FROM MergeMapping_UserMark
-                    WHERE SourceDb = ? AND OldUserMarkId = ?
-                """, (db_path, old_um_id))
-                res = cursor.fetchone()
-                if res:
-                    mapping[(db_path, old_um_id)] = res[0]
-                    mapping[guid] = res[0]
+                res = existing_mapping.get((db_path, old_um_id))
+                if res is not None:
+                    mapping[(db_path, old_um_id)] = res
+                    mapping[guid] = res
                     continue
 
                 # Appliquer mapping LocationId
                 new_loc = location_id_map.get((db_path, loc_id), loc_id) if loc_id is not None else None
 
                 # Vérifier si le GUID existe déjà et récupérer toutes ses données
-                cursor.execute("""
-                    SELECT UserMarkId, ColorIndex, LocationId, StyleIndex, Version 
-                    FROM UserMark WHERE UserMarkGuid = ?
-                """, (guid,))
-                existing = cursor.fetchone()
+                existing = usermark_by_guid.get(guid)
 
                 if existing:
                     existing_id, existing_color, existing_loc, existing_style, existing_version = existing
@@ -1237,86 +1444,83 @@ def merge_usermark_from_sources(merged_db_path, file1_db, file2_db, location_id_
                     if (color, new_loc, style, version) == (
                     existing_color, existing_loc, existing_style, existing_version):
                         new_um_id = existing_id
-                        print(f"⏩ UserMark guid={guid} déjà présent (identique), réutilisé (ID={new_um_id})")
+                        logger.debug("UserMark guid=%s déjà présent (identique), réutilisé (ID=%s)", guid, new_um_id)
                     else:
                         # Données différentes - générer un nouveau GUID
                         new_guid = str(uuid.uuid4())
                         max_id += 1
                         new_um_id = max_id
-                        cursor.execute("""
-                            INSERT INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        """, (new_um_id, color, new_loc, style, new_guid, version))
-                        print(
-                            f"⚠️ Conflit UserMark guid={guid}, nouvelle entrée créée avec nouveau GUID (NewID={new_um_id})")
+                        usermarks_to_insert.append((new_um_id, color, new_loc, style, new_guid, version))
+                        usermark_by_guid[new_guid] = (new_um_id, color, new_loc, style, version)
+                        logger.debug("Conflit UserMark guid=%s, nouvelle entrée créée avec nouveau GUID (NewID=%s)",
+                                     guid, new_um_id)
                 else:
                     # Nouvel enregistrement
                     max_id += 1
                     new_um_id = max_id
-                    cursor.execute("""
-                        INSERT INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (new_um_id, color, new_loc, style, guid, version))
-                    print(f"✅ Insertion UserMark guid={guid}, NewID={new_um_id}")
+                    usermarks_to_insert.append((new_um_id, color, new_loc, style, guid, version))
+                    usermark_by_guid[guid] = (new_um_id, color, new_loc, style, version)
+                    logger.debug("Insertion UserMark guid=%s, NewID=%s", guid, new_um_id)
 
                 # Mise à jour des mappings
                 mapping[(db_path, old_um_id)] = new_um_id
                 mapping[guid] = new_um_id
-                cursor.execute("""
-                    INSERT OR REPLACE INTO MergeMapping_UserMark (SourceDb, OldUserMarkId, NewUserMarkId)
-                    VALUES (?, ?, ?)
-                """, (db_path, old_um_id, new_um_id))
+                mappings_to_insert.append((db_path, old_um_id, new_um_id))
+                existing_mapping[(db_path, old_um_id)] = new_um_id
+
+        cursor.executemany("""
+            INSERT INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, usermarks_to_insert)
+        print(f"✅ UserMark insérés depuis {os.path.basename(os.path.dirname(db_path))} : {len(usermarks_to_insert)}")
+        cursor.executemany("""
+            INSERT OR REPLACE INTO MergeMapping_UserMark (SourceDb, OldUserMarkId, NewUserMarkId)
+            VALUES (?, ?, ?)
+        """, mappings_to_insert)
 
     conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
     print("Fusion UserMark terminée (idempotente).", flush=True)
-    return mapping
+    # usermark_by_guid reflète exactement la table UserMark fusionnée : GUID -> UserMarkId
+    # sans relire la table
+    return mapping, {guid: values[0] for guid, values in usermark_by_guid.items()}
 
 
 def insert_usermark_if_needed(conn, usermark_tuple):
     """
-    Insère ou met à jour un UserMark si besoin.
+    Insère ou met à jour un UserMark si besoin, en une seule instruction (UPSERT sur UserMarkGuid).
     usermark_tuple = (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
     """
     (um_id, color, loc, style, guid, version) = usermark_tuple
 
-    cur = conn.cursor()
-
-    # Vérifie s'il existe déjà un UserMark avec ce GUID
-    existing = cur.execute("""
-        SELECT UserMarkId, ColorIndex, LocationId, StyleIndex, Version 
-        FROM UserMark 
-        WHERE UserMarkGuid = ?
-    """, (guid,)).fetchone()
-
-    if existing:
-        existing_id, ex_color, ex_loc, ex_style, ex_version = existing
-
-        if (ex_color, ex_loc, ex_style, ex_version) == (color, loc, style, version):
-            # Identique -> rien à faire
-            print(f"⏩ UserMark guid={guid} déjà présent et identique, insertion ignorée.")
-            return
-
-        # Sinon : on fait un UPDATE pour aligner
-        print(f"⚠️ Conflit détecté pour UserMark guid={guid}. Mise à jour des champs.")
-        cur.execute("""
-            UPDATE UserMark
-            SET ColorIndex = ?, LocationId = ?, StyleIndex = ?, Version = ?
-            WHERE UserMarkGuid = ?
-        """, (color, loc, style, version, guid))
+    # Insertion, ou mise à jour des champs si le GUID existe avec des valeurs différentes
+    # (la clause WHERE laisse intacte une ligne identique)
+    try:
+        cur = conn.execute("""
+            INSERT INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(UserMarkGuid) DO UPDATE SET
+                ColorIndex = excluded.ColorIndex,
+                LocationId = excluded.LocationId,
+                StyleIndex = excluded.StyleIndex,
+                Version = excluded.Version
+            WHERE ColorIndex IS NOT excluded.ColorIndex
+               OR LocationId IS NOT excluded.LocationId
+               OR StyleIndex IS NOT excluded.StyleIndex
+               OR Version IS NOT excluded.Version
+        """, (um_id, color, loc, style, guid, version))
+    except sqlite3.Error as e:
+        logger.warning("Erreur lors de l'insertion du UserMark guid=%s: %s", guid, e)
+        return
+
+    if cur.rowcount == 0:
+        logger.debug("UserMark guid=%s déjà présent et identique, insertion ignorée.", guid)
     else:
-        # N'existe pas → insertion
-        try:
-            cur.execute("""
-                INSERT INTO UserMark (UserMarkId, ColorIndex, LocationId, StyleIndex, UserMarkGuid, Version)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (um_id, color, loc, style, guid, version))
-            print(f"✅ UserMark guid={guid} inséré avec ID={um_id}")
-        except Exception as e:
-            print(f"❌ Erreur lors de l'insertion du UserMark guid={guid}: {e}")
+        logger.debug("UserMark guid=%s inséré ou mis à jour (ID=%s)", guid, um_id)
 
 
-def merge_location_from_sources(merged_db_path, file1_db, file2_db):
+def merge_location_from_sources(merged_db_path, file1_db, file2_db, conn=None):
     """
     Fusionne les enregistrements de la table Location depuis file1 et file2
     dans la base fusionnée de façon idempotente.
@@ -1327,23 +1531,26 @@ def merge_location_from_sources(merged_db_path, file1_db, file2_db):
     print("\n[FUSION LOCATION - IDÉMPOTENTE]", flush=True)
 
     def read_locations(db_path):
-        with sqlite3.connect(db_path) as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT LocationId, BookNumber, ChapterNumber, DocumentId, Track,
-                       IssueTagNumber, KeySymbol, MepsLanguage, Type, Title
-                FROM Location
-            """)
-            return [(db_path,) + row for row in cur.fetchall()]
-
-    # Lecture combinée des deux fichiers
-    locations = read_locations(file1_db) + read_locations(file2_db)
+        # Lecture en flux par paquets : la table source n'est jamais entièrement en mémoire
+        cur = get_conn(db_path).cursor()
+        cur.execute("""
+            SELECT LocationId, BookNumber, ChapterNumber, DocumentId, Track,
+                   IssueTagNumber, KeySymbol, MepsLanguage, Type, Title
+            FROM Location
+        """)
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
 
-    # Connexion à la base fusionnée
-    with sqlite3.connect(merged_db_path) as conn:
+    # Connexion à la base fusionnée (PRAGMA de fusion, transactions explicites)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
+    try:
         cur = conn.cursor()
 
-        # Créer la table de mapping si elle n'existe pas
+        # Créer la table de mapping si elle n'existe pas (validée seule, en autocommit)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS MergeMapping_Location (
                 SourceDb TEXT,
@@ -1352,74 +1559,90 @@ def merge_location_from_sources(merged_db_path, file1_db, file2_db):
                 PRIMARY KEY (SourceDb, OldID)
             )
         """)
-        # Premier commit pour créer la table
-        print("🐞 [BEFORE commit in merge_location_from_sources]", file=sys.stderr, flush=True)
-        conn.commit()
-        print("🐞 [AFTER commit in merge_location_from_sources]", file=sys.stderr, flush=True)
+        # Toute la boucle d'insertion dans une seule transaction, verrou d'écriture pris d'emblée
+        conn.execute("BEGIN IMMEDIATE")
 
-        # Récupérer le plus grand LocationId existant
-        cur.execute("SELECT COALESCE(MAX(LocationId), 0) FROM Location")
-        current_max_id = cur.fetchone()[0]
+        # Mappings déjà enregistrés et index des Location existantes, chargés une seule fois.
+        # Clé naturelle = les 9 colonnes comparées ; la première LocationId rencontrée l'emporte,
+        # comme le faisait le SELECT ... fetchone() par ligne.
+        cur.execute("SELECT SourceDb, OldID, NewID FROM MergeMapping_Location")
+        existing_mapping = {(src, old_id): new_id for src, old_id, new_id in cur.fetchall()}
+
+        cur.execute("""
+            SELECT LocationId, BookNumber, ChapterNumber, DocumentId, Track,
+                   IssueTagNumber, KeySymbol, MepsLanguage, Type, Title
+            FROM Location
+            ORDER BY LocationId
+        """)
+        loc_index = {}
+        for loc_id, *natural_key in cur.fetchall():
+            loc_index.setdefault(tuple(natural_key), loc_id)
 
         location_id_map = {}
+        pending_mappings = []
+        already_merged = found_count = inserted_count = 0
+
+        # Le chemin source est porté par la boucle externe, sans tuple (db_path,) + row par ligne
+        for db_source in (file1_db, file2_db):
+            for (old_loc_id, book_num, chap_num, doc_id, track, issue, key_sym, meps_lang, loc_type,
+                 title) in read_locations(db_source):
+                # Vérifier mapping existant
+                new_id = existing_mapping.get((db_source, old_loc_id))
+                if new_id is not None:
+                    logger.debug("Location déjà fusionnée OldID=%s → NewID=%s (Source: %s)", old_loc_id, new_id, db_source)
+                    already_merged += 1
+                    location_id_map[(db_source, old_loc_id)] = new_id
+                    continue
 
-        for db_source, old_loc_id, book_num, chap_num, doc_id, track, issue, key_sym, meps_lang, loc_type, title in locations:
-            # Vérifier mapping existant
-            cur.execute("""
-                SELECT NewID FROM MergeMapping_Location
-                WHERE SourceDb = ? AND OldID = ?
-            """, (db_source, old_loc_id))
-            res = cur.fetchone()
-            if res:
-                new_id = res[0]
-                print(f"⏩ Location déjà fusionnée OldID={old_loc_id} → NewID={new_id} (Source: {db_source})", flush=True)
-                location_id_map[(db_source, old_loc_id)] = new_id
-                continue
+                # Recherche d'une correspondance exacte (IssueTagNumber et Type comparés par "=" :
+                # une valeur NULL ne correspond jamais, comme en SQL)
+                natural_key = (book_num, chap_num, doc_id, track, issue, key_sym, meps_lang, loc_type, title)
+                existing_id = None
+                if issue is not None and loc_type is not None:
+                    existing_id = loc_index.get(natural_key)
+
+                if existing_id is not None:
+                    new_id = existing_id
+                    logger.debug("Location existante trouvée OldID=%s → NewID=%s (Source: %s)", old_loc_id, new_id, db_source)
+                    found_count += 1
+                else:
+                    # Pas trouvée → insertion, LocationId attribué par SQLite (INTEGER PRIMARY KEY)
+                    try:
+                        cur.execute("""
+                            INSERT INTO Location
+                            (BookNumber, ChapterNumber, DocumentId, Track,
+                             IssueTagNumber, KeySymbol, MepsLanguage, Type, Title)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """, (book_num, chap_num, doc_id, track, issue, key_sym, meps_lang, loc_type, title))
+                        new_id = cur.lastrowid
+                        logger.debug("Location insérée : NewID=%s (Source: %s)", new_id, db_source)
+                        inserted_count += 1
+                    except sqlite3.IntegrityError as e:
+                        logger.warning("Erreur insertion Location OldID=%s: %s", old_loc_id, e)
+                        continue
+                    loc_index.setdefault(natural_key, new_id)
 
-            # Recherche d'une correspondance exacte
-            cur.execute("""
-                SELECT LocationId FROM Location
-                WHERE
-                    BookNumber IS ? AND
-                    ChapterNumber IS ? AND
-                    DocumentId IS ? AND
-                    Track IS ? AND
-                    IssueTagNumber = ? AND
-                    KeySymbol IS ? AND
-                    MepsLanguage IS ? AND
-                    Type = ? AND
-                    Title IS ?
-            """, (book_num, chap_num, doc_id, track, issue, key_sym, meps_lang, loc_type, title))
-            existing = cur.fetchone()
-
-            if existing:
-                new_id = existing[0]
-                print(f"🔎 Location existante trouvée OldID={old_loc_id} → NewID={new_id} (Source: {db_source})", flush=True)
-            else:
-                # Pas trouvée → insertion
-                current_max_id += 1
-                new_id = current_max_id
-                try:
-                    cur.execute("""
-                        INSERT INTO Location
-                        (LocationId, BookNumber, ChapterNumber, DocumentId, Track,
-                         IssueTagNumber, KeySymbol, MepsLanguage, Type, Title)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (new_id, book_num, chap_num, doc_id, track, issue, key_sym, meps_lang, loc_type, title))
-                    print(f"✅ Location insérée : NewID={new_id} (Source: {db_source})", flush=True)
-                except sqlite3.IntegrityError as e:
-                    print(f"❌ Erreur insertion Location OldID={old_loc_id}: {e}", flush=True)
-                    continue
+                # Mettre à jour le mapping en mémoire et dans la table de mapping
+                location_id_map[(db_source, old_loc_id)] = new_id
+                existing_mapping.setdefault((db_source, old_loc_id), new_id)
+                pending_mappings.append((db_source, old_loc_id, new_id))
 
-            # Mettre à jour le mapping en mémoire et dans la table de mapping
-            location_id_map[(db_source, old_loc_id)] = new_id
-            cur.execute("""
-                INSERT OR IGNORE INTO MergeMapping_Location (SourceDb, OldID, NewID)
-                VALUES (?, ?, ?)
-            """, (db_source, old_loc_id, new_id))
+        # Table de mapping alimentée en un seul executemany
+        cur.executemany("""
+            INSERT OR IGNORE INTO MergeMapping_Location (SourceDb, OldID, NewID)
+            VALUES (?, ?, ?)
+        """, pending_mappings)
 
         # Commit final pour toutes les insertions de Location
         conn.commit()
+        print(f"📊 Location : {inserted_count} insérées, {found_count} déjà présentes, "
+              f"{already_merged} déjà fusionnées", flush=True)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if not shared_conn:
+            conn.close()
 
     # Sortie de la fonction
     print("🐞 [BEFORE final print in merge_location_from_sources]", file=sys.stderr, flush=True)
@@ -1453,14 +1676,17 @@ def upload_files():
     file1_path = os.path.join(extracted1, "userData.db")
     file2_path = os.path.join(extracted2, "userData.db")
 
+    # Les connexions en cache pointent sur les anciens fichiers
+    close_cached_conns()
+
     if os.path.exists(file1_path):
         os.remove(file1_path)
     if os.path.exists(file2_path):
         os.remove(file2_path)
 
-    # Sauvegarde des fichiers userData.db
-    file1.save(file1_path)
-    file2.save(file2_path)
+    # Sauvegarde des fichiers userData.db, par gros blocs
+    file1.save(file1_path, buffer_size=UPLOAD_BUFFER_SIZE)
+    file2.save(file2_path, buffer_size=UPLOAD_BUFFER_SIZE)
 
     response = jsonify({"message": "Fichiers userData.db reçus et enregistrés avec succès !"})
     response.headers.add("Access-Control-Allow-Origin", "*")
@@ -1505,42 +1731,28 @@ def compare_data():
     notes1 = {note[1]: note[2] for note in data1.get("notes", [])}
     notes2 = {note[1]: note[2] for note in data2.get("notes", [])}
 
-    identical_notes = {}
-    conflicts_notes = {}
-    unique_notes_file1 = {}
-    unique_notes_file2 = {}
-
-    for title in set(notes1.keys()).intersection(set(notes2.keys())):
-        if notes1[title] == notes2[title]:
-            identical_notes[title] = notes1[title]
-        else:
-            conflicts_notes[title] = {"file1": notes1[title], "file2": notes2[title]}
-
-    for title in set(notes1.keys()).difference(set(notes2.keys())):
-        unique_notes_file1[title] = notes1[title]
+    def split_by_key(values1, values2):
+        # Une seule passe par clé : vues de clés (k1 & k2, k1 - k2, k2 - k1) sans reconstruire de sets
+        keys1, keys2 = values1.keys(), values2.keys()
+        identical = {}
+        conflicts = {}
+        for key in keys1 & keys2:
+            v1, v2 = values1[key], values2[key]
+            if v1 == v2:
+                identical[key] = v1
+            else:
+                conflicts[key] = {"file1": v1, "file2": v2}
+        unique_file1 = {key: values1[key] for key in keys1 - keys2}
+        unique_file2 = {key: values2[key] for key in keys2 - keys1}
+        return identical, conflicts, unique_file1, unique_file2
 
-    for title in set(notes2.keys()).difference(set(notes1.keys())):
-        unique_notes_file2[title] = notes2[title]
+    identical_notes, conflicts_notes, unique_notes_file1, unique_notes_file2 = split_by_key(notes1, notes2)
 
     highlights1 = {h[1]: h[2] for h in data1.get("highlights", [])}
     highlights2 = {h[1]: h[2] for h in data2.get("highlights", [])}
 
-    identical_highlights = {}
-    conflicts_highlights = {}
-    unique_highlights_file1 = {}
-    unique_highlights_file2 = {}
-
-    for loc in set(highlights1.keys()).intersection(set(highlights2.keys())):
-        if highlights1[loc] == highlights2[loc]:
-            identical_highlights[loc] = highlights1[loc]
-        else:
-            conflicts_highlights[loc] = {"file1": highlights1[loc], "file2": highlights2[loc]}
-
-    for loc in set(highlights1.keys()).difference(set(highlights2.keys())):
-        unique_highlights_file1[loc] = highlights1[loc]
-
-    for loc in set(highlights2.keys()).difference(set(highights1.keys())):
-        unique_highlights_file2[loc] = highlights2[loc]
+    (identical_highlights, conflicts_highlights,
+     unique_highlights_file1, unique_highlights_file2) = split_by_key(highlights1, highlights2)
 
     result = {
         "notes": {
@@ -1562,11 +1774,40 @@ def compare_data():
     return response, 200
 
 
-def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, location_id_map, item_id_map, tag_choices):
+def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, location_id_map, item_id_map, tag_choices,
+                          conn=None):
     print("\n[FUSION TAGS ET TAGMAP - AVEC CHOIX UTILISATEUR]", flush=True)
 
-    with sqlite3.connect(merged_db_path, timeout=15) as conn:
-        conn.execute("PRAGMA journal_mode = DELETE")
+    def read_source_tags(db_path):
+        cur = get_conn(db_path).cursor()
+        cur.execute("SELECT TagId, Type, Name FROM Tag")
+        tags = cur.fetchall()
+        cur.execute("""
+            SELECT TagMapId, PlaylistItemId, LocationId, NoteId, TagId, Position
+            FROM TagMap
+        """)
+        return tags, cur.fetchall()
+
+    # Lecture des deux sources en parallèle (fichiers indépendants), avant toute écriture
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_tags, source_tagmaps = {}, {}
+        for db_path, (tags, tagmaps) in zip((file1_db, file2_db),
+                                            executor.map(read_source_tags, (file1_db, file2_db))):
+            source_tags[db_path] = tags
+            source_tagmaps[db_path] = tagmaps
+    tags_by_id = {db_path: {row[0]: row for row in tags} for db_path, tags in source_tags.items()}
+
+    def find_source_tag(db_path, tag_id):
+        # Les ids venant du frontend peuvent être des chaînes ("3") : même conversion que le
+        # WHERE TagId = ? de SQLite sur une colonne INTEGER
+        try:
+            return tags_by_id[db_path].get(int(tag_id))
+        except (TypeError, ValueError):
+            return None
+
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
+    try:
         cursor = conn.cursor()
 
         cursor.execute("""
@@ -1585,11 +1826,17 @@ def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, loca
                 PRIMARY KEY (SourceDb, OldTagMapId)
             )
         """)
-        conn.commit()
+        # Tags et TagMap fusionnés dans une seule transaction
+        conn.execute("BEGIN IMMEDIATE")
 
-        cursor.execute("SELECT COALESCE(MAX(TagId), 0) FROM Tag")
-        max_tag_id = cursor.fetchone()[0]
+        # TagId et TagMapId sont attribués par SQLite (INTEGER PRIMARY KEY) et relus via lastrowid
         tag_id_map = {}
+
+        # Mappings Tag déjà enregistrés (chargés une fois) ; les nouveaux sont accumulés
+        # puis écrits en un seul executemany
+        cursor.execute("SELECT SourceDb, OldTagId, NewTagId FROM MergeMapping_Tag")
+        mapped_tags = {(src, old_id): new_id for src, old_id, new_id in cursor.fetchall()}
+        pending_tag_mappings = []
         processed_tags_guid = set() # Pour suivre les tags uniques par GUID ou par (Type, Name)
 
         # Première passe: Collecte et traitement des tags avec les choix utilisateur
@@ -1604,20 +1851,14 @@ def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, loca
             # Récupérer les tags originaux des bases de données source
             tag1_data = None
             if original_tag_ids.get("file1"):
-                with sqlite3.connect(file1_db) as src_conn:
-                    src_cursor = src_conn.cursor()
-                    src_cursor.execute("SELECT TagId, Type, Name FROM Tag WHERE TagId = ?", (original_tag_ids["file1"],))
-                    tag1_data = src_cursor.fetchone() # (TagId, Type, Name)
+                tag1_data = find_source_tag(file1_db, original_tag_ids["file1"])  # (TagId, Type, Name)
 
             tag2_data = None
             if original_tag_ids.get("file2"):
-                with sqlite3.connect(file2_db) as src_conn:
-                    src_cursor = src_conn.cursor()
-                    src_cursor.execute("SELECT TagId, Type, Name FROM Tag WHERE TagId = ?", (original_tag_ids["file2"],))
-                    tag2_data = src_cursor.fetchone() # (TagId, Type, Name)
+                tag2_data = find_source_tag(file2_db, original_tag_ids["file2"])  # (TagId, Type, Name)
 
             if choice == "ignore":
-                print(f"⏩ Tag frontend index {frontend_index_str} ignoré par choix utilisateur.", flush=True)
+                logger.debug("Tag frontend index %s ignoré par choix utilisateur.", frontend_index_str)
                 continue
 
             tag_to_insert = None
@@ -1653,17 +1894,16 @@ def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, loca
                 old_tag_id, tag_type, tag_name = tag_to_insert
 
                 # Appliquer les modifications du frontend (Nom du Tag)
-                edited_name = edited.get(source_db_for_mapping.replace(os.path.normpath(file1_db), "file1").replace(os.path.normpath(file2_db), "file2"), {}).get("Name")
+                edited_name = edited.get(source_db_for_mapping.replace(cached_normpath(file1_db), "file1").replace(cached_normpath(file2_db), "file2"), {}).get("Name")
                 if edited_name:
                     tag_name = edited_name
 
                 # Vérifier si ce tag_id de source a déjà été mappé.
-                cursor.execute("SELECT NewTagId FROM MergeMapping_Tag WHERE SourceDb = ? AND OldTagId = ?",
-                               (source_db_for_mapping, old_tag_id))
-                res = cursor.fetchone()
-                if res:
-                    tag_id_map[(source_db_for_mapping, old_tag_id)] = res[0]
-                    print(f"⏩ Tag OldID {old_tag_id} de {os.path.basename(source_db_for_mapping)} déjà mappé à NewID {res[0]}", flush=True)
+                already_mapped = mapped_tags.get((source_db_for_mapping, old_tag_id))
+                if already_mapped is not None:
+                    tag_id_map[(source_db_for_mapping, old_tag_id)] = already_mapped
+                    logger.debug("Tag OldID %s de %s déjà mappé à NewID %s",
+                                 old_tag_id, cached_basename(source_db_for_mapping), already_mapped)
                     continue
 
                 # Chercher si un tag avec le même Type et Name (potentiellement édité) existe déjà dans la base fusionnée
@@ -1673,14 +1913,13 @@ def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, loca
                 new_tag_id = None
                 if existing:
                     new_tag_id = existing[0]
-                    print(f"⏩ Tag existant trouvé (Type: {tag_type}, Nom: '{tag_name}'). Mappé à TagId existant: {new_tag_id}", flush=True)
+                    logger.debug("Tag existant trouvé (Type: %s, Nom: '%s'). Mappé à TagId existant: %s",
+                                 tag_type, tag_name, new_tag_id)
                 else:
-                    max_tag_id += 1
-                    new_tag_id = max_tag_id
                     try:
-                        cursor.execute("INSERT INTO Tag (TagId, Type, Name) VALUES (?, ?, ?)",
-                                       (new_tag_id, tag_type, tag_name))
-                        print(f"✅ Tag inséré: NewID {new_tag_id} (Type: {tag_type}, Nom: '{tag_name}')", flush=True)
+                        cursor.execute("INSERT INTO Tag (Type, Name) VALUES (?, ?)", (tag_type, tag_name))
+                        new_tag_id = cursor.lastrowid
+                        logger.debug("Tag inséré: NewID %s (Type: %s, Nom: '%s')", new_tag_id, tag_type, tag_name)
                     except sqlite3.IntegrityError as e:
                         print(f"❌ Erreur d'intégrité lors de l'insertion du Tag (Type: {tag_type}, Nom: '{tag_name}'): {e}", flush=True)
                         # Tenter de récupérer l'ID si une insertion concurrente a eu lieu
@@ -1688,164 +1927,162 @@ def merge_tags_and_tagmap(merged_db_path, file1_db, file2_db, note_mapping, loca
                         existing_after_error = cursor.fetchone()
                         if existing_after_error:
                             new_tag_id = existing_after_error[0]
-                            print(f"⏩ Récupération de l'ID existant {new_tag_id} suite à un échec d'insertion.", flush=True)
+                            logger.debug("Récupération de l'ID existant %s suite à un échec d'insertion.", new_tag_id)
                         else:
                             print(f"⚠️ Échec critique de l'insertion ou de la récupération du tag. Ignoré.", flush=True)
                             continue
 
                 if new_tag_id:
                     tag_id_map[(source_db_for_mapping, old_tag_id)] = new_tag_id
-                    cursor.execute("INSERT INTO MergeMapping_Tag (SourceDb, OldTagId, NewTagId) VALUES (?, ?, ?)",
-                                   (source_db_for_mapping, old_tag_id, new_tag_id))
+                    mapped_tags[(source_db_for_mapping, old_tag_id)] = new_tag_id
+                    pending_tag_mappings.append((source_db_for_mapping, old_tag_id, new_tag_id))
 
         # Assurez-vous que tous les tags des sources sont mappés même s'ils n'étaient pas dans tag_choices (pour les TagMap qui y réfèrent)
         # Ceci gère les tags qui n'ont pas de conflit et n'apparaissent donc pas dans tag_choices.
         # Ils devraient être ajoutés automatiquement s'ils n'existent pas.
         for db_path in [file1_db, file2_db]:
-            with sqlite3.connect(db_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                src_cursor.execute("SELECT TagId, Type, Name FROM Tag")
-                for tag_id, tag_type, tag_name in src_cursor.fetchall():
-                    if (db_path, tag_id) not in tag_id_map: # Si ce tag n'a pas été traité par les choix utilisateur
-                        cursor.execute("SELECT NewTagId FROM MergeMapping_Tag WHERE SourceDb = ? AND OldTagId = ?",
-                                       (db_path, tag_id))
-                        res = cursor.fetchone()
-                        if res:
-                            tag_id_map[(db_path, tag_id)] = res[0]
-                            continue
+            db_name = cached_basename(db_path)  # invariant de boucle, pour les messages
+            for tag_id, tag_type, tag_name in source_tags[db_path]:
+                if (db_path, tag_id) not in tag_id_map: # Si ce tag n'a pas été traité par les choix utilisateur
+                    already_mapped = mapped_tags.get((db_path, tag_id))
+                    if already_mapped is not None:
+                        tag_id_map[(db_path, tag_id)] = already_mapped
+                        continue
 
-                        cursor.execute("SELECT TagId FROM Tag WHERE Type = ? AND Name = ?", (tag_type, tag_name))
-                        existing = cursor.fetchone()
-                        if existing:
-                            new_tag_id = existing[0]
-                        else:
-                            max_tag_id += 1
-                            new_tag_id = max_tag_id
-                            try:
-                                cursor.execute("INSERT INTO Tag (TagId, Type, Name) VALUES (?, ?, ?)",
-                                               (new_tag_id, tag_type, tag_name))
-                            except sqlite3.IntegrityError:
-                                cursor.execute("SELECT TagId FROM Tag WHERE Type = ? AND Name = ?", (tag_type, tag_name))
-                                existing_after_error = cursor.fetchone()
-                                if existing_after_error:
-                                    new_tag_id = existing_after_error[0]
-                                else:
-                                    print(f"⚠️ Échec d'auto-insertion/récupération du tag {tag_name} de {os.path.basename(db_path)}. Ignoré.", flush=True)
-                                    continue
+                    cursor.execute("SELECT TagId FROM Tag WHERE Type = ? AND Name = ?", (tag_type, tag_name))
+                    existing = cursor.fetchone()
+                    if existing:
+                        new_tag_id = existing[0]
+                    else:
+                        try:
+                            cursor.execute("INSERT INTO Tag (Type, Name) VALUES (?, ?)", (tag_type, tag_name))
+                            new_tag_id = cursor.lastrowid
+                        except sqlite3.IntegrityError:
+                            cursor.execute("SELECT TagId FROM Tag WHERE Type = ? AND Name = ?", (tag_type, tag_name))
+                            existing_after_error = cursor.fetchone()
+                            if existing_after_error:
+                                new_tag_id = existing_after_error[0]
+                            else:
+                                print(f"⚠️ Échec d'auto-insertion/récupération du tag {tag_name} de {db_name}. Ignoré.", flush=True)
+                                continue
 
-                        if new_tag_id:
-                            tag_id_map[(db_path, tag_id)] = new_tag_id
-                            cursor.execute("INSERT INTO MergeMapping_Tag (SourceDb, OldTagId, NewTagId) VALUES (?, ?, ?)",
-                                           (db_path, tag_id, new_tag_id))
-                            print(f"✅ Tag auto-inséré/mappé: OldID {tag_id} de {os.path.basename(db_path)} -> NewID {new_tag_id} (Nom: '{tag_name}')", flush=True)
+                    if new_tag_id:
+                        tag_id_map[(db_path, tag_id)] = new_tag_id
+                        mapped_tags[(db_path, tag_id)] = new_tag_id
+                        pending_tag_mappings.append((db_path, tag_id, new_tag_id))
+                        logger.debug("Tag auto-inséré/mappé: OldID %s de %s -> NewID %s (Nom: '%s')",
+                                     tag_id, db_name, new_tag_id, tag_name)
 
-        normalized_note_mapping = {
-            (os.path.normpath(k[0]), k[1]): v
-            for k, v in note_mapping.items()
-        }
+        cursor.executemany("INSERT INTO MergeMapping_Tag (SourceDb, OldTagId, NewTagId) VALUES (?, ?, ?)",
+                           pending_tag_mappings)
 
-        cursor.execute("SELECT COALESCE(MAX(TagMapId), 0) FROM TagMap")
-        max_tagmap_id = cursor.fetchone()[0]
         tagmap_id_map = {}
+        pending_tagmap_mappings = []
+        tagmap_skipped = tagmap_identical = 0
 
-        for db_path in [file1_db, file2_db]:
-            with sqlite3.connect(db_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                src_cursor.execute("""
-                    SELECT TagMapId, PlaylistItemId, LocationId, NoteId, TagId, Position
-                    FROM TagMap
-                """)
-                rows = src_cursor.fetchall()
-
-                for old_tm_id, playlist_item_id, location_id, note_id, old_tag_id, position in rows:
-                    new_tag_id = tag_id_map.get((db_path, old_tag_id))
-                    if new_tag_id is None:
-                        print(
-                            f"⛔ Ignoré TagMap {old_tm_id}: TagId={old_tag_id} de {os.path.basename(db_path)} non mappé (tag parent absent ou ignoré).",
-                            flush=True)
-                        continue
+        # TagMap existants indexés par (TagId, PlaylistItemId, LocationId, NoteId, Position),
+        # chargés une fois : remplace le SELECT de doublon exécuté pour chaque ligne source
+        cursor.execute("""
+            SELECT TagMapId, TagId, PlaylistItemId, LocationId, NoteId, Position
+            FROM TagMap
+            ORDER BY TagMapId
+        """)
+        existing_tagmaps = {}
+        for tm_id, *tagmap_key in cursor.fetchall():
+            existing_tagmaps.setdefault(tuple(tagmap_key), tm_id)
 
-                    if note_id:
-                        new_note_id = normalized_note_mapping.get((os.path.normpath(db_path), note_id))
-                        if new_note_id is None:
-                            print(
-                                f"⛔ Ignoré TagMap {old_tm_id}: note_id={note_id} de {os.path.basename(db_path)} PAS trouvée dans note_mapping (note parent absente ou ignorée).",
-                                flush=True)
-                            continue
-                    else:
-                        new_note_id = None
+        for db_path in [file1_db, file2_db]:
+            # note_mapping, location_id_map et item_id_map sont indexés par chemin normalisé
+            db_path_norm = cached_normpath(db_path)
+            db_name = cached_basename(db_path)
+            rows = source_tagmaps[db_path]
+
+            for old_tm_id, playlist_item_id, location_id, note_id, old_tag_id, position in rows:
+                new_tag_id = tag_id_map.get((db_path, old_tag_id))
+                if new_tag_id is None:
+                    logger.debug("Ignoré TagMap %s: TagId=%s de %s non mappé (tag parent absent ou ignoré).",
+                                 old_tm_id, old_tag_id, db_name)
+                    tagmap_skipped += 1
+                    continue
 
-                    new_loc_id = location_id_map.get((os.path.normpath(db_path), location_id)) if location_id else None
-                    new_pi_id = item_id_map.get(
-                        (os.path.normpath(db_path), playlist_item_id)) if playlist_item_id else None
+                if note_id:
+                    new_note_id = note_mapping.get((db_path_norm, note_id))
+                    if new_note_id is None:
+                        logger.debug("Ignoré TagMap %s: note_id=%s de %s PAS trouvée dans note_mapping "
+                                     "(note parent absente ou ignorée).",
+                                     old_tm_id, note_id, db_name)
+                        tagmap_skipped += 1
+                        continue
+                else:
+                    new_note_id = None
 
-                    if sum(x is not None for x in [new_note_id, new_loc_id, new_pi_id]) != 1:
-                        print(
-                            f"⛔ Ignoré TagMap {old_tm_id}: lié à aucun ou plusieurs éléments cibles après mapping. (NoteId:{new_note_id}, LocationId:{new_loc_id}, PlaylistItemId:{new_pi_id})",
-                            flush=True)
-                        continue
+                new_loc_id = location_id_map.get((db_path_norm, location_id)) if location_id else None
+                new_pi_id = item_id_map.get((db_path_norm, playlist_item_id)) if playlist_item_id else None
 
-                    cursor.execute("""
-                        SELECT TagMapId FROM TagMap
-                        WHERE TagId=?
-                          AND IFNULL(PlaylistItemId,-1)=IFNULL(?, -1)
-                          AND IFNULL(LocationId,-1)=IFNULL(?, -1)
-                          AND IFNULL(NoteId,-1)=IFNULL(?, -1)
-                          AND Position=?
-                    """, (new_tag_id, new_pi_id, new_loc_id, new_note_id, position))
-                    existing_tagmap = cursor.fetchone()
-                    if existing_tagmap:
-                        tagmap_id_map[(db_path, old_tm_id)] = existing_tagmap[0]
-                        print(
-                            f"⏩ TagMap identique trouvé: OldTagMapId {old_tm_id} de {os.path.basename(db_path)} → NewTagMapId {existing_tagmap[0]}",
-                            flush=True)
-                        continue
+                if sum(x is not None for x in [new_note_id, new_loc_id, new_pi_id]) != 1:
+                    logger.debug("Ignoré TagMap %s: lié à aucun ou plusieurs éléments cibles après mapping. "
+                                 "(NoteId:%s, LocationId:%s, PlaylistItemId:%s)",
+                                 old_tm_id, new_note_id, new_loc_id, new_pi_id)
+                    tagmap_skipped += 1
+                    continue
 
-                    tentative_position = position
-                    while True:
-                        cursor.execute(
-                            "SELECT 1 FROM TagMap WHERE TagId=? AND Position=? AND IFNULL(PlaylistItemId,-1)=IFNULL(?, -1) AND IFNULL(LocationId,-1)=IFNULL(?, -1) AND IFNULL(NoteId,-1)=IFNULL(?, -1)",
-                            (new_tag_id, tentative_position, new_pi_id, new_loc_id, new_note_id)
-                        )
-                        if not cursor.fetchone():
-                            break
-                        tentative_position += 1
-
-                    max_tagmap_id += 1
-                    new_tagmap_id = max_tagmap_id
-                    cursor.execute("""
-                        INSERT INTO TagMap
-                        (TagMapId, PlaylistItemId, LocationId, NoteId, TagId, Position)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (new_tagmap_id, new_pi_id, new_loc_id, new_note_id, new_tag_id, tentative_position))
+                tagmap_key = (new_tag_id, new_pi_id, new_loc_id, new_note_id, position)
+                existing_tagmap_id = existing_tagmaps.get(tagmap_key)
+                if existing_tagmap_id is not None:
+                    tagmap_id_map[(db_path, old_tm_id)] = existing_tagmap_id
+                    logger.debug("TagMap identique trouvé: OldTagMapId %s de %s → NewTagMapId %s",
+                                 old_tm_id, db_name, existing_tagmap_id)
+                    tagmap_identical += 1
+                    continue
 
-                    cursor.execute("""
-                        INSERT INTO MergeMapping_TagMap
-                        (SourceDb, OldTagMapId, NewTagMapId)
-                        VALUES (?, ?, ?)
-                    """, (db_path, old_tm_id, new_tagmap_id))
+                # Pas de doublon exact à cette position : la ligne garde sa Position d'origine
+                # (l'ancienne boucle de sondage s'arrêtait toujours au premier tour)
+                tentative_position = position
 
-                    tagmap_id_map[(db_path, old_tm_id)] = new_tagmap_id
-                    print(
-                        f"✅ TagMap inséré: OldTagMapId {old_tm_id} de {os.path.basename(db_path)} → NewTagMapId {new_tagmap_id}",
-                        flush=True)
+                cursor.execute("""
+                    INSERT INTO TagMap
+                    (PlaylistItemId, LocationId, NoteId, TagId, Position)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (new_pi_id, new_loc_id, new_note_id, new_tag_id, tentative_position))
+                new_tagmap_id = cursor.lastrowid
+                existing_tagmaps[tagmap_key] = new_tagmap_id
+
+                pending_tagmap_mappings.append((db_path, old_tm_id, new_tagmap_id))
+
+                tagmap_id_map[(db_path, old_tm_id)] = new_tagmap_id
+                logger.debug("TagMap inséré: OldTagMapId %s de %s → NewTagMapId %s",
+                             old_tm_id, db_name, new_tagmap_id)
+
+        cursor.executemany("""
+            INSERT INTO MergeMapping_TagMap
+            (SourceDb, OldTagMapId, NewTagMapId)
+            VALUES (?, ?, ?)
+        """, pending_tagmap_mappings)
 
-        print(f"Au total, {len(tagmap_id_map)} TagMap ont été mappées/inserées", flush=True)
+        print(f"Au total, {len(tagmap_id_map)} TagMap ont été mappées/inserées "
+              f"({tagmap_identical} identiques, {tagmap_skipped} ignorées)", flush=True)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if not shared_conn:
+            conn.close()
 
     print("✔ Fusion des Tags et TagMap terminée (avec choix utilisateur).", flush=True)
 
     return tag_id_map, tagmap_id_map
 
 
-def merge_playlist_items(merged_db_path, file1_db, file2_db, im_mapping=None):
+def merge_playlist_items(merged_db_path, file1_db, file2_db, im_mapping=None, conn=None):
     """
     Fusionne PlaylistItem de façon idempotente.
     """
     print("\n[FUSION PLAYLISTITEMS - IDÉMPOTENTE]")
 
     mapping = {}
-    conn = sqlite3.connect(merged_db_path, timeout=30)
-    conn.execute("PRAGMA busy_timeout = 10000")
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -1856,16 +2093,14 @@ def merge_playlist_items(merged_db_path, file1_db, file2_db, im_mapping=None):
             PRIMARY KEY (SourceDb, OldItemId)
         )
     """)
-    conn.commit()
 
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='PlaylistItem'")
     if not cursor.fetchone():
         print("[ERREUR] La table PlaylistItem n'existe pas dans la DB fusionnée.")
-        conn.close()
+        if not shared_conn:
+            conn.close()
         return {}
 
-    import hashlib
-
     def safe_text(val):
         return val if val is not None else ""
 
@@ -1873,157 +2108,179 @@ def merge_playlist_items(merged_db_path, file1_db, file2_db, im_mapping=None):
         return val if val is not None else 0
 
     def generate_full_key(label, start_trim, end_trim, accuracy, end_action, thumbnail_path):
-        normalized = f"{label}|{start_trim}|{end_trim}|{accuracy}|{end_action}|{thumbnail_path}"
-        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        # La clé ne sert qu'à la comparaison dans existing_items : la chaîne normalisée suffit
+        # (même égalité que son SHA-256, sans le calcul de hachage par ligne)
+        return f"{label}|{start_trim}|{end_trim}|{accuracy}|{end_action}|{thumbnail_path}"
 
     existing_items = {}
 
     def read_playlist_items(db_path):
-        with sqlite3.connect(db_path) as src_conn:
-            cur_source = src_conn.cursor()
-            cur_source.execute("""
-                SELECT PlaylistItemId, Label, StartTrimOffsetTicks, EndTrimOffsetTicks, Accuracy, EndAction, ThumbnailFilePath
-                FROM PlaylistItem
-            """)
-            return [(db_path,) + row for row in cur_source.fetchall()]
-
-    all_items = read_playlist_items(file1_db) + read_playlist_items(file2_db)
-    print(f"Total playlist items lus : {len(all_items)}")
-
-    for item in all_items:
-        db_source = item[0]
-        old_id, label, start_trim, end_trim, accuracy, end_action, thumb_path = item[1:]
-
-        norm_label = safe_text(label)
-        norm_start = safe_number(start_trim)
-        norm_end = safe_number(end_trim)
-        norm_thumb = safe_text(thumb_path)
+        # Lecture en flux par paquets, comme pour les Location
+        cur_source = get_conn(db_path).cursor()
+        cur_source.execute("""
+            SELECT PlaylistItemId, Label, StartTrimOffsetTicks, EndTrimOffsetTicks, Accuracy, EndAction, ThumbnailFilePath
+            FROM PlaylistItem
+        """)
+        while True:
+            rows = cur_source.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
+
+    items_read = 0
+
+    # Mappings déjà enregistrés (chargés une fois) ; les nouveaux sont écrits en un seul executemany
+    cursor.execute("SELECT SourceDb, OldItemId, NewItemId FROM MergeMapping_PlaylistItem")
+    mapped_items = {(src, old_id): new_id for src, old_id, new_id in cursor.fetchall()}
+    pending_mappings = []
+
+    # Insertions et mapping dans une seule transaction
+    conn.execute("BEGIN IMMEDIATE")
+    # Le chemin source est porté par la boucle externe, sans tuple (db_path,) + row par ligne
+    for db_source in (file1_db, file2_db):
+        for old_id, label, start_trim, end_trim, accuracy, end_action, thumb_path in read_playlist_items(db_source):
+            items_read += 1
+
+            norm_label = safe_text(label)
+            norm_start = safe_number(start_trim)
+            norm_end = safe_number(end_trim)
+            norm_thumb = safe_text(thumb_path)
+
+            key = generate_full_key(norm_label, norm_start, norm_end, accuracy, end_action, norm_thumb)
+
+            new_id = mapped_items.get((db_source, old_id))
+            if new_id is not None:
+                mapping[(db_source, old_id)] = new_id
+                if key not in existing_items:
+                    existing_items[key] = new_id
+                continue
 
-        key = generate_full_key(norm_label, norm_start, norm_end, accuracy, end_action, norm_thumb)
+            if key in existing_items:
+                new_id = existing_items[key]
+            else:
+                try:
+                    cursor.execute("""
+                        INSERT INTO PlaylistItem 
+                        (Label, StartTrimOffsetTicks, EndTrimOffsetTicks, Accuracy, EndAction, ThumbnailFilePath)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (label, start_trim, end_trim, accuracy, end_action, thumb_path))
+                    new_id = cursor.lastrowid
+                    existing_items[key] = new_id
+                except sqlite3.IntegrityError as e:
+                    print(f"Erreur insertion PlaylistItem OldID {old_id} de {db_source}: {e}")
+                    continue
 
-        cursor.execute("SELECT NewItemId FROM MergeMapping_PlaylistItem WHERE SourceDb = ? AND OldItemId = ?", (db_source, old_id))
-        res = cursor.fetchone()
-        if res:
-            new_id = res[0]
+            mapped_items[(db_source, old_id)] = new_id
+            pending_mappings.append((db_source, old_id, new_id))
             mapping[(db_source, old_id)] = new_id
-            if key not in existing_items:
-                existing_items[key] = new_id
-            continue
-
-        if key in existing_items:
-            new_id = existing_items[key]
-        else:
-            try:
-                cursor.execute("""
-                    INSERT INTO PlaylistItem 
-                    (Label, StartTrimOffsetTicks, EndTrimOffsetTicks, Accuracy, EndAction, ThumbnailFilePath)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (label, start_trim, end_trim, accuracy, end_action, thumb_path))
-                new_id = cursor.lastrowid
-                existing_items[key] = new_id
-            except sqlite3.IntegrityError as e:
-                print(f"Erreur insertion PlaylistItem OldID {old_id} de {db_source}: {e}")
-                continue
-
-        cursor.execute("""
-            INSERT INTO MergeMapping_PlaylistItem (SourceDb, OldItemId, NewItemId)
-            VALUES (?, ?, ?)
-        """, (db_source, old_id, new_id))
-        mapping[(db_source, old_id)] = new_id
 
+    cursor.executemany("""
+        INSERT INTO MergeMapping_PlaylistItem (SourceDb, OldItemId, NewItemId)
+        VALUES (?, ?, ?)
+    """, pending_mappings)
     conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
+    print(f"Total playlist items lus : {items_read}")
     print(f"Total PlaylistItems mappés: {len(mapping)}", flush=True)
     return mapping
 
 
-def merge_playlist_item_accuracy(merged_db_path, file1_db, file2_db):
+def merge_playlist_item_accuracy(merged_db_path, file1_db, file2_db, conn=None):
     print("\n[FUSION PLAYLISTITEMACCURACY]")
 
-    conn = sqlite3.connect(merged_db_path)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
     cursor.execute("SELECT COALESCE(MAX(PlaylistItemAccuracyId), 0) FROM PlaylistItemAccuracy")
     max_acc_id = cursor.fetchone()[0] or 0
     print(f"ID max initial: {max_acc_id}")
 
-    for db_path in [file1_db, file2_db]:
+    # Copie entièrement côté SQLite : chaque source est attachée puis fusionnée en un INSERT…SELECT
+    for alias, db_path in (("src1", file1_db), ("src2", file2_db)):
+        attached = False
         try:
-            with sqlite3.connect(db_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                src_cursor.execute("SELECT PlaylistItemAccuracyId, Description FROM PlaylistItemAccuracy")
-                records = src_cursor.fetchall()
-                print(f"{len(records)} records trouvés dans {os.path.basename(db_path)}")
-
-                for acc_id, desc in records:
-                    cursor.execute("""
-                        INSERT OR IGNORE INTO PlaylistItemAccuracy (PlaylistItemAccuracyId, Description)
-                        VALUES (?, ?)
-                    """, (acc_id, desc))
-                    max_acc_id = max(max_acc_id, acc_id)
+            conn.execute(f"ATTACH DATABASE ? AS {alias}", (f"file:{os.path.abspath(db_path)}?mode=ro",))
+            attached = True
+            conn.execute("BEGIN")
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO main.PlaylistItemAccuracy (PlaylistItemAccuracyId, Description)
+                SELECT PlaylistItemAccuracyId, Description
+                FROM {alias}.PlaylistItemAccuracy
+            """)
+            cursor.execute(f"""
+                SELECT COUNT(*), COALESCE(MAX(PlaylistItemAccuracyId), 0)
+                FROM {alias}.PlaylistItemAccuracy
+            """)
+            record_count, source_max_id = cursor.fetchone()
+            conn.commit()
+            print(f"{record_count} records trouvés dans {cached_basename(db_path)}")
+            max_acc_id = max(max_acc_id, source_max_id)
         except Exception as e:
+            conn.rollback()
             print(f"⚠️ Erreur lors du traitement de {db_path}: {e}")
+        finally:
+            if attached:
+                conn.execute(f"DETACH DATABASE {alias}")
 
-    conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
     print(f"ID max final: {max_acc_id}", flush=True)
     return max_acc_id
 
 
-def merge_playlist_item_location_map(merged_db_path, file1_db, file2_db, item_id_map, location_id_map):
+def merge_playlist_item_location_map(merged_db_path, file1_db, file2_db, item_id_map, location_id_map, conn=None):
     print("\n[FUSION PLAYLISTITEMLOCATIONMAP]")
 
-    conn = sqlite3.connect(merged_db_path)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
     # Étape 1: Vider complètement la table
+    conn.execute("BEGIN")
     cursor.execute("DELETE FROM PlaylistItemLocationMap")
     print("🗑️ Table PlaylistItemLocationMap vidée avant reconstruction")
 
     total_inserted = 0
     total_skipped = 0
 
-    # Étape 2: Reconstruction avec mapping
-    for db_path in [file1_db, file2_db]:
-        normalized_db = os.path.normpath(db_path)
-        with sqlite3.connect(db_path) as src_conn:
-            src_cursor = src_conn.cursor()
-            src_cursor.execute("""
-                SELECT PlaylistItemId, LocationId, MajorMultimediaType, BaseDurationTicks
-                FROM PlaylistItemLocationMap
-            """)
-            mappings = src_cursor.fetchall()
-            print(f"{len(mappings)} mappings trouvés dans {os.path.basename(db_path)}")
-
-            for old_item_id, old_loc_id, mm_type, duration in mappings:
-                new_item_id = item_id_map.get((normalized_db, old_item_id))
-                new_loc_id = location_id_map.get((normalized_db, old_loc_id))
-
-                if new_item_id is None or new_loc_id is None:
-                    print(f"⚠️ Ignoré: PlaylistItemId={old_item_id} ou LocationId={old_loc_id} non mappé (source: {os.path.basename(db_path)})")
-                    total_skipped += 1
-                    continue
-
-                try:
-                    cursor.execute("""
-                        INSERT INTO PlaylistItemLocationMap
-                        (PlaylistItemId, LocationId, MajorMultimediaType, BaseDurationTicks)
-                        VALUES (?, ?, ?, ?)
-                    """, (new_item_id, new_loc_id, mm_type, duration))
-                    print(f"✅ Insertion: PlaylistItemId={new_item_id}, LocationId={new_loc_id}")
-                    total_inserted += 1
-                except sqlite3.IntegrityError as e:
-                    print(f"⚠️ Doublon ignoré: {e}")
-                    total_skipped += 1
-
+    # Étape 2: Reconstruction avec mapping, entièrement côté SQLite : les mappings sont chargés
+    # en tables temporaires et chaque source attachée est réécrite par jointure
+    load_id_map_into_temp(conn, "item_map", item_id_map)
+    load_id_map_into_temp(conn, "loc_map", location_id_map)
     conn.commit()
 
+    for db_path in [file1_db, file2_db]:
+        normalized_db = cached_normpath(db_path)
+        conn.execute("ATTACH DATABASE ? AS src", (f"file:{os.path.abspath(db_path)}?mode=ro",))
+        conn.execute("BEGIN")
+        cursor.execute("SELECT COUNT(*) FROM src.PlaylistItemLocationMap")
+        source_count = cursor.fetchone()[0]
+        print(f"{source_count} mappings trouvés dans {cached_basename(db_path)}")
+
+        # ORDER BY : même ordre que la lecture de la source, donc même ligne conservée en cas de doublon
+        cursor.execute("""
+            INSERT OR IGNORE INTO main.PlaylistItemLocationMap
+            (PlaylistItemId, LocationId, MajorMultimediaType, BaseDurationTicks)
+            SELECT im.NewId, lm.NewId, s.MajorMultimediaType, s.BaseDurationTicks
+            FROM src.PlaylistItemLocationMap s
+            JOIN temp.item_map im ON im.SourceDb = ? AND im.OldId = s.PlaylistItemId
+            JOIN temp.loc_map lm ON lm.SourceDb = ? AND lm.OldId = s.LocationId
+            ORDER BY s.PlaylistItemId, s.LocationId
+        """, (normalized_db, normalized_db))
+        total_inserted += cursor.rowcount
+        total_skipped += source_count - cursor.rowcount
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
+
     print(f"📊 Résultat: {total_inserted} lignes insérées, {total_skipped} ignorées")
     cursor.execute("SELECT COUNT(*) FROM PlaylistItemLocationMap")
     count = cursor.fetchone()[0]
     print(f"🔍 Total final dans PlaylistItemLocationMap: {count} lignes", flush=True)
 
-    conn.close()
+    if not shared_conn:
+        conn.close()
 
 
 def cleanup_playlist_item_location_map(conn):
@@ -2038,169 +2295,195 @@ def cleanup_playlist_item_location_map(conn):
     print("🧹 Nettoyage post-merge : PlaylistItemLocationMap nettoyée.", flush=True)
 
 
-def merge_playlist_item_independent_media_map(merged_db_path, file1_db, file2_db, item_id_map, independent_media_map):
+def merge_playlist_item_independent_media_map(merged_db_path, file1_db, file2_db, item_id_map, independent_media_map,
+                                              conn=None):
     """
     Fusionne PlaylistItemIndependentMediaMap avec adaptation du mapping.
     """
     print("\n[FUSION PlaylistItemIndependentMediaMap]")
-    conn = sqlite3.connect(merged_db_path)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
     # 🧹 On vide la table avant de la reconstruire proprement
+    conn.execute("BEGIN")
     cursor.execute("DELETE FROM PlaylistItemIndependentMediaMap")
 
     inserted = 0
     skipped = 0
+    load_id_map_into_temp(conn, "item_map", item_id_map)
+    load_id_map_into_temp(conn, "media_map", independent_media_map)
+    conn.commit()
 
     for db_path in [file1_db, file2_db]:
-        normalized_db = os.path.normpath(db_path)
-        with sqlite3.connect(db_path) as src_conn:
-            src_cursor = src_conn.cursor()
-            src_cursor.execute("""
-                SELECT PlaylistItemId, IndependentMediaId, DurationTicks
-                FROM PlaylistItemIndependentMediaMap
-            """)
-            rows = src_cursor.fetchall()
-            print(f"{len(rows)} lignes trouvées dans {os.path.basename(db_path)}")
-
-            for old_item_id, old_media_id, duration_ticks in rows:
-                new_item_id = item_id_map.get((normalized_db, old_item_id))
-                new_media_id = independent_media_map.get((normalized_db, old_media_id))
-
-                if new_item_id is None or new_media_id is None:
-                    print(f"⚠️ Mapping manquant pour PlaylistItemId={old_item_id}, IndependentMediaId={old_media_id} (source: {normalized_db})")
-                    skipped += 1
-                    continue
+        normalized_db = cached_normpath(db_path)
+        conn.execute("ATTACH DATABASE ? AS src", (f"file:{os.path.abspath(db_path)}?mode=ro",))
+        conn.execute("BEGIN")
+        cursor.execute("SELECT COUNT(*) FROM src.PlaylistItemIndependentMediaMap")
+        source_count = cursor.fetchone()[0]
+        print(f"{source_count} lignes trouvées dans {cached_basename(db_path)}")
 
-                try:
-                    cursor.execute("""
-                        INSERT INTO PlaylistItemIndependentMediaMap
-                        (PlaylistItemId, IndependentMediaId, DurationTicks)
-                        VALUES (?, ?, ?)
-                    """, (new_item_id, new_media_id, duration_ticks))
-                    inserted += 1
-                except sqlite3.IntegrityError as e:
-                    print(f"🚫 Doublon ignoré : {e}")
-                    skipped += 1
+        cursor.execute("""
+            INSERT OR IGNORE INTO main.PlaylistItemIndependentMediaMap
+            (PlaylistItemId, IndependentMediaId, DurationTicks)
+            SELECT im.NewId, mm.NewId, s.DurationTicks
+            FROM src.PlaylistItemIndependentMediaMap s
+            JOIN temp.item_map im ON im.SourceDb = ? AND im.OldId = s.PlaylistItemId
+            JOIN temp.media_map mm ON mm.SourceDb = ? AND mm.OldId = s.IndependentMediaId
+            ORDER BY s.PlaylistItemId, s.IndependentMediaId
+        """, (normalized_db, normalized_db))
+        inserted += cursor.rowcount
+        skipped += source_count - cursor.rowcount
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
 
-    conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
     print(f"✅ PlaylistItemIndependentMediaMap : {inserted} insérés, {skipped} ignorés.", flush=True)
 
 
-def merge_playlist_item_marker(merged_db_path, file1_db, file2_db, item_id_map):
+def merge_playlist_item_marker(merged_db_path, file1_db, file2_db, item_id_map, conn=None):
     """
     Fusionne la table PlaylistItemMarker de façon idempotente.
     Retourne marker_id_map.
     """
     print("\n[FUSION PLAYLISTITEMMARKER]")
-    conn = sqlite3.connect(merged_db_path)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
+    # WITHOUT ROWID : la clé composite est la table elle-même, pas de second B-tree à maintenir
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS MergeMapping_PlaylistItemMarker (
             SourceDb TEXT,
             OldMarkerId INTEGER,
             NewMarkerId INTEGER,
             PRIMARY KEY (SourceDb, OldMarkerId)
-        )
+        ) WITHOUT ROWID
     """)
-    conn.commit()
 
+    conn.execute("BEGIN")
     cursor.execute("SELECT COALESCE(MAX(PlaylistItemMarkerId), 0) FROM PlaylistItemMarker")
     max_marker_id = cursor.fetchone()[0] or 0
     print(f"ID max initial: {max_marker_id}")
     marker_id_map = {}
 
-    for db_path in [file1_db, file2_db]:
-        normalized_db = os.path.normpath(db_path)
-        with sqlite3.connect(db_path) as src_conn:
-            src_cursor = src_conn.cursor()
-            src_cursor.execute("""
-                SELECT PlaylistItemMarkerId, PlaylistItemId, Label, StartTimeTicks, DurationTicks, EndTransitionDurationTicks
-                FROM PlaylistItemMarker
-            """)
-            markers = src_cursor.fetchall()
-            print(f"{len(markers)} markers trouvés dans {os.path.basename(db_path)}")
+    # Mappings déjà enregistrés, chargés une fois ; les nouveaux sont écrits en un seul executemany
+    cursor.execute("SELECT SourceDb, OldMarkerId, NewMarkerId FROM MergeMapping_PlaylistItemMarker")
+    mapped_markers = {(src, old_id): new_id for src, old_id, new_id in cursor.fetchall()}
+    pending_mappings = []
 
-            for old_marker_id, old_item_id, label, start_time, duration, end_transition in markers:
-                new_item_id = item_id_map.get((normalized_db, old_item_id))
-                if not new_item_id:
-                    print(f"    > ID item introuvable pour marker {old_marker_id} — ignoré")
-                    continue
+    # Clés UNIQUE(PlaylistItemId, StartTimeTicks) déjà prises : les doublons sont écartés
+    # avant l'executemany au lieu d'attraper une IntegrityError ligne par ligne
+    cursor.execute("SELECT PlaylistItemId, StartTimeTicks FROM PlaylistItemMarker")
+    used_marker_keys = set(cursor.fetchall())
+    item_id_get = item_id_map.get
+    mapped_marker_get = mapped_markers.get
 
-                # Utiliser la version normalisée aussi ici
-                cursor.execute("""
-                    SELECT NewMarkerId FROM MergeMapping_PlaylistItemMarker
-                    WHERE SourceDb = ? AND OldMarkerId = ?
-                """, (normalized_db, old_marker_id))
-                res = cursor.fetchone()
-                if res:
-                    marker_id_map[(normalized_db, old_marker_id)] = res[0]
-                    continue
+    for db_path in [file1_db, file2_db]:
+        normalized_db = cached_normpath(db_path)
+        src_conn = get_conn(db_path)
+        src_cursor = src_conn.cursor()
+        src_cursor.execute("""
+            SELECT PlaylistItemMarkerId, PlaylistItemId, Label, StartTimeTicks, DurationTicks, EndTransitionDurationTicks
+            FROM PlaylistItemMarker
+        """)
+        markers = src_cursor.fetchall()
+        print(f"{len(markers)} markers trouvés dans {cached_basename(db_path)}")
+        new_markers = []
+
+        for old_marker_id, old_item_id, label, start_time, duration, end_transition in markers:
+            new_item_id = item_id_get((normalized_db, old_item_id))
+            if not new_item_id:
+                print(f"    > ID item introuvable pour marker {old_marker_id} — ignoré")
+                continue
 
-                max_marker_id += 1
-                new_row = (max_marker_id, new_item_id, label, start_time, duration, end_transition)
+            # Utiliser la version normalisée aussi ici
+            res = mapped_marker_get((normalized_db, old_marker_id))
+            if res is not None:
+                marker_id_map[(normalized_db, old_marker_id)] = res
+                continue
 
-                try:
-                    cursor.execute("""
-                        INSERT INTO PlaylistItemMarker
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, new_row)
-                    marker_id_map[(normalized_db, old_marker_id)] = max_marker_id
-                    cursor.execute("""
-                        INSERT INTO MergeMapping_PlaylistItemMarker (SourceDb, OldMarkerId, NewMarkerId)
-                        VALUES (?, ?, ?)
-                    """, (normalized_db, old_marker_id, max_marker_id))
-                    conn.commit()
-                except sqlite3.IntegrityError as e:
-                    print(f"🚫 Erreur insertion PlaylistItemMarker pour OldMarkerId {old_marker_id}: {e}")
+            max_marker_id += 1
+            if (new_item_id, start_time) in used_marker_keys:
+                print(f"🚫 Erreur insertion PlaylistItemMarker pour OldMarkerId {old_marker_id}: "
+                      f"UNIQUE constraint failed: PlaylistItemMarker.PlaylistItemId, PlaylistItemMarker.StartTimeTicks")
+                continue
+
+            used_marker_keys.add((new_item_id, start_time))
+            new_markers.append((max_marker_id, new_item_id, label, start_time, duration, end_transition))
+            marker_id_map[(normalized_db, old_marker_id)] = max_marker_id
+            mapped_markers[(normalized_db, old_marker_id)] = max_marker_id
+            pending_mappings.append((normalized_db, old_marker_id, max_marker_id))
+
+        cursor.executemany("""
+            INSERT INTO PlaylistItemMarker
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, new_markers)
+
+    # Un seul executemany et un seul commit au lieu d'un INSERT + commit par marker
+    cursor.executemany("""
+        INSERT INTO MergeMapping_PlaylistItemMarker (SourceDb, OldMarkerId, NewMarkerId)
+        VALUES (?, ?, ?)
+    """, pending_mappings)
+    conn.commit()
 
     print(f"ID max final: {max_marker_id}")
     print(f"Total markers mappés: {len(marker_id_map)}")
-    conn.close()
+    if not shared_conn:
+        conn.close()
     return marker_id_map
 
 
-def merge_marker_maps(merged_db_path, file1_db, file2_db, marker_id_map):
+def merge_marker_maps(merged_db_path, file1_db, file2_db, marker_id_map, conn=None):
     """
     Fusionne les tables de mapping liées aux markers, y compris PlaylistItemMarkerBibleVerseMap
     et PlaylistItemMarkerParagraphMap.
     """
     print("\n[FUSION MARKER MAPS]")
-    conn = sqlite3.connect(merged_db_path)
+    shared_conn = conn is not None
+    conn = open_merged_db(merged_db_path, conn)
     cursor = conn.cursor()
 
-    for map_type in ['BibleVerse', 'Paragraph']:
-        table_name = f'PlaylistItemMarker{map_type}Map'
-        cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'")
-        if not cursor.fetchone():
+    # Une requête par table, construite une seule fois à partir de la liste fixe des tables et
+    # de leurs colonnes : même texte SQL pour les deux sources, donc réutilisé depuis le cache
+    insert_sql_by_table = {}
+    map_tables = ('PlaylistItemMarkerBibleVerseMap', 'PlaylistItemMarkerParagraphMap')
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN (?, ?)", map_tables)
+    existing_tables = {row[0] for row in cursor.fetchall()}
+    for table_name in map_tables:
+        if table_name not in existing_tables:
             print(f"Table {table_name} non trouvée - ignorée")
             continue
-        print(f"\nFusion de {table_name}")
+        # La première colonne est PlaylistItemMarkerId, remappée par la jointure
+        columns = [col[1] for col in cursor.execute(f"PRAGMA main.table_info({table_name})").fetchall()]
+        other_columns = "".join(f", s.{col}" for col in columns[1:])
+        insert_sql_by_table[table_name] = f"""
+            INSERT OR IGNORE INTO main.{table_name} ({", ".join(columns)})
+            SELECT m.NewId{other_columns}
+            FROM src.{table_name} s
+            JOIN temp.marker_map m
+              ON m.SourceDb = ? AND m.OldId = s.{columns[0]}
+        """
+
+    # marker_id_map chargé dans une table temporaire : la réécriture des IDs se fait par jointure
+    conn.execute("BEGIN")
+    load_id_map_into_temp(conn, "marker_map", marker_id_map)
+    conn.commit()
 
-        for db_path in [file1_db, file2_db]:
-            normalized_db = os.path.normpath(db_path)
-            with sqlite3.connect(db_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                src_cursor.execute(f"SELECT * FROM {table_name}")
-                rows = src_cursor.fetchall()
-                print(f"{len(rows)} entrées trouvées dans {os.path.basename(db_path)} pour {table_name}")
-
-                for row in rows:
-                    old_marker_id = row[0]
-                    new_marker_id = marker_id_map.get((normalized_db, old_marker_id))
-                    if not new_marker_id:
-                        continue
-                    new_row = (new_marker_id,) + row[1:]
-                    placeholders = ",".join(["?"] * len(new_row))
-                    try:
-                        cursor.execute(f"INSERT OR IGNORE INTO {table_name} VALUES ({placeholders})", new_row)
-                    except sqlite3.IntegrityError as e:
-                        print(f"Erreur dans {table_name}: {e}")
+    # Les sources sont attachées l'une après l'autre sous le même alias
+    for db_path in (file1_db, file2_db):
+        normalized_db = cached_normpath(db_path)
+        conn.execute("ATTACH DATABASE ? AS src", (f"file:{os.path.abspath(db_path)}?mode=ro",))
+        conn.execute("BEGIN")
+        for table_name, insert_sql in insert_sql_by_table.items():
+            cursor.execute(insert_sql, (normalized_db,))
+            print(f"{cursor.rowcount} entrées insérées depuis {cached_basename(db_path)} pour {table_name}")
+        conn.commit()
+        conn.execute("DETACH DATABASE src")
 
-    conn.commit()
-    conn.close()
+    if not shared_conn:
+        conn.close()
 
 
 def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, independent_media_map, item_id_map):
@@ -2215,8 +2498,8 @@ def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, indepen
     conn = None  # 🧷 Pour pouvoir le fermer plus tard
 
     try:
-        conn = sqlite3.connect(merged_db_path, timeout=30)
-        conn.execute("PRAGMA busy_timeout = 10000")
+        # Une seule connexion d'écriture pour toutes les sous-fusions (tables temporaires et cache partagés)
+        conn = open_merged_db(merged_db_path)
         cursor = conn.cursor()
 
         print("\n[INITIALISATION]")
@@ -2226,7 +2509,7 @@ def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, indepen
         print(f"Location IDs mappés: {len(location_id_map)}")
 
         item_id_map = merge_playlist_items(
-            merged_db_path, file1_db, file2_db, independent_media_map  # ✅ 4 max
+            merged_db_path, file1_db, file2_db, independent_media_map, conn=conn
         )
 
         # Appel immédiat à merge_playlist_items pour avoir item_id_map dispo dès le début
@@ -2237,12 +2520,12 @@ def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, indepen
         marker_id_map = {}
 
         # 1. Fusion de PlaylistItemAccuracy
-        max_acc_id = merge_playlist_item_accuracy(merged_db_path, file1_db, file2_db)
+        max_acc_id = merge_playlist_item_accuracy(merged_db_path, file1_db, file2_db, conn=conn)
         print(f"--> PlaylistItemAccuracy fusionnée, max ID final: {max_acc_id}")
 
         # 2. Fusion PlaylistItemMarker
         # Fusion de PlaylistItemMarker et récupération du mapping des markers
-        marker_id_map = merge_playlist_item_marker(merged_db_path, file1_db, file2_db, item_id_map)
+        marker_id_map = merge_playlist_item_marker(merged_db_path, file1_db, file2_db, item_id_map, conn=conn)
         print(f"--> PlaylistItemMarker fusionnée, markers mappés: {len(marker_id_map)}")
 
         # 3. Fusion des PlaylistItemMarkerMap et Marker*Map (BibleVerse/Paragraph)
@@ -2250,21 +2533,21 @@ def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, indepen
 
         # 4. Fusion des PlaylistItemMarkerBibleVerseMap et ParagraphMap
         # Fusion des MarkerMaps (BibleVerse, Paragraph, etc.)
-        merge_marker_maps(merged_db_path, file1_db, file2_db, marker_id_map)
+        merge_marker_maps(merged_db_path, file1_db, file2_db, marker_id_map, conn=conn)
         print("--> MarkerMaps fusionnées.")
 
         # 5. Fusion de PlaylistItemIndependentMediaMap
         # Fusion de PlaylistItemIndependentMediaMap (basée sur PlaylistItemIndependentMediaMap)
-        merge_playlist_item_independent_media_map(merged_db_path, file1_db, file2_db, item_id_map, independent_media_map)
+        merge_playlist_item_independent_media_map(merged_db_path, file1_db, file2_db, item_id_map, independent_media_map,
+                                                  conn=conn)
         print("--> PlaylistItemIndependentMediaMap fusionnée.")
 
         # 6. Fusion PlaylistItemLocationMap
-        merge_playlist_item_location_map(merged_db_path, file1_db, file2_db, item_id_map, location_id_map)
+        merge_playlist_item_location_map(merged_db_path, file1_db, file2_db, item_id_map, location_id_map, conn=conn)
         print("--> PlaylistItemLocationMap fusionnée.")
 
         # Nettoyage : retirer les mappings avec des PlaylistItemId fantômes
-        with sqlite3.connect(merged_db_path) as conn:
-            cleanup_playlist_item_location_map(conn)
+        cleanup_playlist_item_location_map(conn)
 
         # ========================
         # Maintenant, on démarre les opérations qui ouvrent leurs propres connexions
@@ -2303,7 +2586,9 @@ def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, indepen
                 'orphaned_thumbnails': len(orphaned_thumbnails) if 'orphaned_thumbnails' in locals() else 0
             }
         }
-        print(f"Résumé intermédiaire: {playlist_results}")
+        print(f"Résumé intermédiaire: {len(item_id_map)} items, {len(marker_id_map)} markers, "
+              f"médias: {playlist_results['media_status']}")
+        logger.debug("Résumé intermédiaire complet: %s", playlist_results)
 
         # 10. Finalisation
         # commit final et fermeture propre
@@ -2313,15 +2598,13 @@ def merge_playlists(merged_db_path, file1_db, file2_db, location_id_map, indepen
         orphaned_deleted = 0  # ou remplace par la vraie valeur si elle est calculée plus haut
         playlist_item_total = len(item_id_map)
 
-        print("\n🧪 DEBUG FINAL DANS merge_playlists")
-        print("Item ID Map complet:", flush=True)
-        for (src, old_id), new_id in item_id_map.items():
-            print(f"  {src} — {old_id} → {new_id}")
+        print(f"\n🧪 Item ID Map : {len(item_id_map)} entrées")
+        if logger.isEnabledFor(logging.DEBUG):
+            for (src, old_id), new_id in item_id_map.items():
+                logger.debug("  %s — %s → %s", src, old_id, new_id)
 
-        with sqlite3.connect(merged_db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA quick_check")
-            integrity_result = cursor.fetchone()[0]
+        cursor.execute("PRAGMA quick_check")
+        integrity_result = cursor.fetchone()[0]
 
         return (
             max_playlist_id,
@@ -2351,15 +2634,14 @@ def check_duplicate_guids_between_sources(file1_db, file2_db):
     guids_file1 = set()
     guids_file2 = set()
 
-    with sqlite3.connect(file1_db) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT UserMarkGuid FROM UserMark")
-        guids_file1 = {row[0] for row in cursor.fetchall()}
+    # Lecture seule via les connexions en cache
+    cursor = get_conn(file1_db).cursor()
+    cursor.execute("SELECT UserMarkGuid FROM UserMark")
+    guids_file1 = {row[0] for row in cursor.fetchall()}
 
-    with sqlite3.connect(file2_db) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT UserMarkGuid FROM UserMark")
-        guids_file2 = {row[0] for row in cursor.fetchall()}
+    cursor = get_conn(file2_db).cursor()
+    cursor.execute("SELECT UserMarkGuid FROM UserMark")
+    guids_file2 = {row[0] for row in cursor.fetchall()}
 
     return guids_file1 & guids_file2
 
@@ -2368,23 +2650,29 @@ def create_note_mapping(merged_db_path, file1_db, file2_db):
     """Crée un mapping (source_db_path, old_note_id) -> new_note_id en se basant sur les GUID."""
     mapping = {}
     try:
-        with sqlite3.connect(merged_db_path, timeout=30) as merged_conn:
+        with sqlite3.connect(merged_db_path, timeout=30, uri=True) as merged_conn:
             merged_conn.execute("PRAGMA busy_timeout = 10000")
             merged_cursor = merged_conn.cursor()
-            merged_cursor.execute("SELECT Guid, NoteId FROM Note")
-            merged_guid_map = {guid: note_id for guid, note_id in merged_cursor.fetchall() if guid}
 
-        for db_path in [file1_db, file2_db]:
-            if not os.path.exists(db_path):
-                print(f"[WARN] Fichier DB manquant : {db_path}")
-                continue
+            # Jointure sur Note.Guid (UNIQUE, donc indexé) directement dans SQLite
+            for db_path in [file1_db, file2_db]:
+                if not os.path.exists(db_path):
+                    print(f"[WARN] Fichier DB manquant : {db_path}")
+                    continue
 
-            with sqlite3.connect(db_path) as src_conn:
-                src_cursor = src_conn.cursor()
-                src_cursor.execute("SELECT NoteId, Guid FROM Note")
-                for old_note_id, guid in src_cursor.fetchall():
-                    if guid and guid in merged_guid_map:
-                        mapping[(db_path, old_note_id)] = merged_guid_map[guid]
+                db_path_norm = cached_normpath(db_path)
+                merged_conn.execute("ATTACH DATABASE ? AS src", (f"file:{os.path.abspath(db_path)}?mode=ro",))
+                try:
+                    merged_cursor.execute("""
+                        SELECT s.NoteId, m.NoteId
+                        FROM src.Note s
+                        JOIN main.Note m ON m.Guid = s.Guid
+                        WHERE s.Guid IS NOT NULL AND s.Guid <> ''
+                    """)
+                    for old_note_id, new_note_id in merged_cursor.fetchall():
+                        mapping[(db_path_norm, old_note_id)] = new_note_id
+                finally:
+                    merged_conn.execute("DETACH DATABASE src")
 
     except Exception as e:
         print(f"[ERREUR] create_note_mapping: {str(e)}")
@@ -2398,26 +2686,26 @@ def merge_platform_metadata(merged_db_path, db1_path, db2_path):
     identifiers = set()
 
     for db_path in [db1_path, db2_path]:
-        with sqlite3.connect(db_path) as src:
-            cursor = src.cursor()
-            try:
-                cursor.execute("SELECT locale FROM android_metadata")
-                locales.update(row[0] for row in cursor.fetchall())
-            except sqlite3.OperationalError:
-                print(f"ℹ️ Table android_metadata absente de {db_path}")
-            except Exception as e:
-                print(f"⚠️ Erreur lecture android_metadata depuis {db_path}: {e}")
+        cursor = get_conn(db_path).cursor()
+        try:
+            cursor.execute("SELECT locale FROM android_metadata")
+            locales.update(row[0] for row in cursor.fetchall())
+        except sqlite3.OperationalError:
+            print(f"ℹ️ Table android_metadata absente de {db_path}")
+        except Exception as e:
+            print(f"⚠️ Erreur lecture android_metadata depuis {db_path}: {e}")
 
-            try:
-                cursor.execute("SELECT identifier FROM grdb_migrations")
-                identifiers.update(row[0] for row in cursor.fetchall())
-            except sqlite3.OperationalError:
-                print(f"ℹ️ Table grdb_migrations absente de {db_path}")
-            except Exception as e:
-                print(f"⚠️ Erreur lecture grdb_migrations depuis {db_path}: {e}")
+        try:
+            cursor.execute("SELECT identifier FROM grdb_migrations")
+            identifiers.update(row[0] for row in cursor.fetchall())
+        except sqlite3.OperationalError:
+            print(f"ℹ️ Table grdb_migrations absente de {db_path}")
+        except Exception as e:
+            print(f"⚠️ Erreur lecture grdb_migrations depuis {db_path}: {e}")
 
     # Une seule connexion d’écriture pour les deux insertions
     with sqlite3.connect(merged_db_path, timeout=15) as conn:
+        apply_merge_pragmas(conn)
         cursor = conn.cursor()
 
         if locales:
@@ -2427,9 +2715,8 @@ def merge_platform_metadata(merged_db_path, db1_path, db2_path):
                 )
             """)
             cursor.execute("DELETE FROM android_metadata")
-            for loc in locales:
-                print(f"✅ INSERT android_metadata.locale = {loc}")
-                cursor.execute("INSERT INTO android_metadata (locale) VALUES (?)", (loc,))
+            cursor.executemany("INSERT INTO android_metadata (locale) VALUES (?)", [(loc,) for loc in locales])
+            print(f"✅ INSERT android_metadata.locale : {', '.join(map(str, locales))}")
 
         if identifiers:
             cursor.execute("""
@@ -2438,20 +2725,28 @@ def merge_platform_metadata(merged_db_path, db1_path, db2_path):
                 )
             """)
             cursor.execute("DELETE FROM grdb_migrations")
-            for ident in sorted(identifiers):
-                print(f"✅ INSERT grdb_migrations.identifier = {ident}")
-                cursor.execute("INSERT INTO grdb_migrations (identifier) VALUES (?)", (ident,))
+            cursor.executemany("INSERT INTO grdb_migrations (identifier) VALUES (?)",
+                               [(ident,) for ident in sorted(identifiers)])
+            print(f"✅ INSERT grdb_migrations.identifier : {len(identifiers)} migrations")
 
 
 def apply_selected_tags(merged_db_path, db1_path, db2_path, note_choices, note_mapping, tag_id_map):
     print("\n[APPLICATION DES TAGS SÉLECTIONNÉS]", flush=True)
 
     with sqlite3.connect(merged_db_path) as conn:
+        apply_merge_pragmas(conn)
         cursor = conn.cursor()
         applied_count = 0
 
-        normalized_db1_path = os.path.normpath(db1_path)
-        normalized_db2_path = os.path.normpath(db2_path)
+        source_paths = {"file1": cached_normpath(db1_path), "file2": cached_normpath(db2_path)}
+
+        # Dernière Position par TagId, lue une seule fois puis incrémentée en mémoire
+        cursor.execute("SELECT TagId, COALESCE(MAX(Position), 0) FROM TagMap GROUP BY TagId")
+        last_position = dict(cursor.fetchall())
+        # NoteId fusionnée -> (source, tags à appliquer), dans l'ordre d'application
+        tags_by_note = {}
+        note_id_get = note_mapping.get
+        tag_id_get = tag_id_map.get
 
         for index_str, note_data in note_choices.items():
             if not isinstance(note_data, dict):
@@ -2468,86 +2763,83 @@ def apply_selected_tags(merged_db_path, db1_path, db2_path, note_choices, note_m
                 print(f"⚠️ 'noteIds' invalide pour l'index '{index_str}': {note_ids}", flush=True)
                 continue
 
-            selected_tags_per_source = note_data.get("selectedTagsPerSource", {})
-            selected_tags_both = note_data.get("selectedTags", [])
-
-            notes_to_process = []
-
+            # Sources concernées par le choix, et clé du payload qui porte les tags à appliquer
             if choice == "both":
-                tags_to_apply = selected_tags_both
-                if not isinstance(tags_to_apply, list):
-                    print(f"⚠️ 'selectedTags' invalide pour le choix 'both' de l'index '{index_str}': {tags_to_apply}",
-                          flush=True)
-                    continue
-
-                if note_ids.get("file1"):
-                    notes_to_process.append((note_ids["file1"], normalized_db1_path, tags_to_apply))
-                if note_ids.get("file2"):
-                    notes_to_process.append((note_ids["file2"], normalized_db2_path, tags_to_apply))
-
+                sources = ("file1", "file2")
+                tags_key = "selectedTags"
+                tags_to_apply = note_data.get("selectedTags", [])
             elif choice in ("file1", "file2"):
-                old_note_id = note_ids.get(choice)
-                tags_to_apply = selected_tags_per_source.get(choice, [])
-
-                if not isinstance(tags_to_apply, list):
-                    print(
-                        f"⚠️ 'selectedTagsPerSource' invalide pour le choix '{choice}' de l'index '{index_str}': {tags_to_apply}",
-                        flush=True)
-                    continue
-
-                if old_note_id:
-                    current_source_db = normalized_db1_path if choice == "file1" else normalized_db2_path
-                    notes_to_process.append((old_note_id, current_source_db, tags_to_apply))
-                else:
-                    print(f"⚠️ Ancien NoteId manquant pour le choix '{choice}' de l'index '{index_str}'.", flush=True)
-                    continue
+                sources = (choice,)
+                tags_key = "selectedTagsPerSource"
+                tags_to_apply = note_data.get("selectedTagsPerSource", {}).get(choice, [])
             else:
                 print(
                     f"⚠️ Choix de fusion '{choice}' non reconnu ou invalide pour l'index '{index_str}'. Tags non traités.",
                     flush=True)
                 continue
 
+            if not isinstance(tags_to_apply, list):
+                print(f"⚠️ '{tags_key}' invalide pour le choix '{choice}' de l'index '{index_str}': {tags_to_apply}",
+                      flush=True)
+                continue
+
+            notes_to_process = [(note_ids[source], source_paths[source], tags_to_apply)
+                                for source in sources if note_ids.get(source)]
+            if choice != "both" and not notes_to_process:
+                print(f"⚠️ Ancien NoteId manquant pour le choix '{choice}' de l'index '{index_str}'.", flush=True)
+                continue
+
             for old_note_id, current_source_db, tags_to_apply in notes_to_process:
-                new_note_id = note_mapping.get((current_source_db, old_note_id))
+                new_note_id = note_id_get((current_source_db, old_note_id))
 
                 if not new_note_id:
                     print(
-                        f"⛔ Nouvelle NoteId introuvable pour la note originale {old_note_id} de {os.path.basename(current_source_db)}. Tags non appliqués.",
+                        f"⛔ Nouvelle NoteId introuvable pour la note originale {old_note_id} de {cached_basename(current_source_db)}. Tags non appliqués.",
                         flush=True)
                     continue
 
-                cursor.execute("DELETE FROM TagMap WHERE NoteId = ?", (new_note_id,))
-                print(
-                    f"🗑️ Suppression des anciens tags pour la NoteId fusionnée: {new_note_id} (source: {os.path.basename(current_source_db)})",
-                    flush=True)
+                # Le dernier choix portant sur une note fusionnée l'emporte, comme lorsque
+                # chaque note effaçait ses tags juste avant d'appliquer les siens
+                tags_by_note.pop(new_note_id, None)
+                tags_by_note[new_note_id] = (current_source_db, tags_to_apply)
 
-                for tag_id in tags_to_apply:
-                    new_tag_id = tag_id_map.get((current_source_db, tag_id))
+        # Les TagMapId libérés par les DELETE ne sont pas réutilisés : les nouveaux partent du max actuel
+        cursor.execute("SELECT COALESCE(MAX(TagMapId), 0) FROM TagMap")
+        last_tagmap_id = cursor.fetchone()[0]
 
-                    if new_tag_id is None:
-                        print(
-                            f"⚠️ TagId '{tag_id}' (provenant de {os.path.basename(current_source_db)}) n'a pas pu être mappé à un TagId fusionné. Non appliqué à NoteId {new_note_id}.",
-                            flush=True)
-                        continue
+        # Anciens tags de toutes les notes concernées effacés en quelques DELETE … IN (…)
+        note_ids_to_clear = list(tags_by_note)
+        for i in range(0, len(note_ids_to_clear), 500):
+            chunk = note_ids_to_clear[i:i + 500]
+            cursor.execute(f"DELETE FROM TagMap WHERE NoteId IN ({','.join('?' * len(chunk))})", chunk)
+        logger.debug("Suppression des anciens tags pour %s NoteId fusionnées", len(note_ids_to_clear))
 
-                    cursor.execute("""
-                        SELECT COALESCE(MAX(Position), 0) + 1 FROM TagMap WHERE TagId = ? AND NoteId = ?
-                    """, (new_tag_id, new_note_id))
-                    position = cursor.fetchone()[0]
+        for new_note_id, (current_source_db, tags_to_apply) in tags_by_note.items():
+            for tag_id in tags_to_apply:
+                new_tag_id = tag_id_get((current_source_db, tag_id))
 
-                    try:
-                        cursor.execute("""
-                            INSERT INTO TagMap (NoteId, TagId, Position)
-                            VALUES (?, ?, ?)
-                        """, (new_note_id, new_tag_id, position))
-                        applied_count += 1
-                        print(
-                            f"📝 Tag '{tag_id}' (nouveau ID:{new_tag_id}) appliqué à NoteId {new_note_id} (pos:{position})",
-                            flush=True)
-                    except sqlite3.IntegrityError as e:
-                        print(
-                            f"❌ Erreur d'intégrité lors de l'insertion TagMap pour NoteId {new_note_id}, TagId {new_tag_id}: {e}",
-                            flush=True)
+                if new_tag_id is None:
+                    print(
+                        f"⚠️ TagId '{tag_id}' (provenant de {cached_basename(current_source_db)}) n'a pas pu être mappé à un TagId fusionné. Non appliqué à NoteId {new_note_id}.",
+                        flush=True)
+                    continue
+
+                position = last_position.get(new_tag_id, 0) + 1
+
+                try:
+                    cursor.execute("""
+                        INSERT INTO TagMap (TagMapId, NoteId, TagId, Position)
+                        VALUES (?, ?, ?, ?)
+                    """, (last_tagmap_id + 1, new_note_id, new_tag_id, position))
+                    last_tagmap_id += 1
+                    last_position[new_tag_id] = position
+                    applied_count += 1
+                    logger.debug("Tag '%s' (nouveau ID:%s) appliqué à NoteId %s (pos:%s)",
+                                 tag_id, new_tag_id, new_note_id, position)
+                except sqlite3.IntegrityError as e:
+                    print(
+                        f"❌ Erreur d'intégrité lors de l'insertion TagMap pour NoteId {new_note_id}, TagId {new_tag_id}: {e}",
+                        flush=True)
 
         conn.commit()
     print(f"✅ Tags appliqués correctement. Total TagMaps insérés/mis à jour: {applied_count}.", flush=True)
@@ -2574,6 +2866,7 @@ def merge_data():
     note_mapping = {}
 
     conn = None  # pour le finally
+    merge_write_conn = None
 
     try:
         payload = request.get_json()
@@ -2595,27 +2888,9 @@ def merge_data():
         if not all(os.path.exists(db) for db in [file1_db, file2_db]):
             return jsonify({"error": "Fichiers source manquants"}), 400
 
-        data1 = read_notes_and_highlights(file1_db)
-        data2 = read_notes_and_highlights(file2_db)
-
-        highlights_db1 = data1["highlights"]
-        highlights_db2 = data2["highlights"]
-        merged_highlights_dict = {}
-        for h in highlights_db1:
-            _, color, loc, style, guid, version = h
-            merged_highlights_dict[guid] = (color, loc, style, version)
-        for h in highlights_db2:
-            _, color2, loc2, style2, guid2, version2 = h
-            if guid2 not in merged_highlights_dict:
-                merged_highlights_dict[guid2] = (color2, loc2, style2, version2)
-            else:
-                (color1, loc1, style1, version1) = merged_highlights_dict[guid2]
-                if (color1 == color2 and loc1 == loc2 and style1 == style2 and version1 == version2):
-                    continue
-                else:
-                    choice = conflict_choices_highlights.get(guid2, "file1")
-                    if choice == "file2":
-                        merged_highlights_dict[guid2] = (color2, loc2, style2, version2)
+        # Un seul checkpoint par source, au début de la fusion (plus dans les fonctions appelées)
+        checkpoint_db(file1_db)
+        checkpoint_db(file2_db)
 
         # === Validation préalable ===
         required_dbs = [
@@ -2630,20 +2905,19 @@ def merge_data():
         if os.path.exists(merged_db_path):
             os.remove(merged_db_path)
         base_db_path = os.path.join(EXTRACT_FOLDER, "file1_extracted", "userData.db")
-        create_merged_schema(merged_db_path, base_db_path)
+        deferred_indexes = create_merged_schema(merged_db_path, base_db_path)
+        # Connexion d'écriture partagée par les étapes de fusion (chacune garde sa propre transaction)
+        merge_write_conn = open_merged_db(merged_db_path)
 
         # juste après create_merged_schema(merged_db_path, base_db_path)
         print("\n→ Debug: listing des tables juste après create_merged_schema")
-        with sqlite3.connect(merged_db_path) as dbg_conn:
-            dbg_cur = dbg_conn.cursor()
-            dbg_cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = [t[0] for t in dbg_cur.fetchall()]
-            print("Tables présentes dans merged_userData.db :", tables)
+        tables = [t[0] for t in merge_write_conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        print("Tables présentes dans merged_userData.db :", tables)
 
         # ── Fusion des Location ──
         print("🐞 [BEFORE merge_location_from_sources]", flush=True)
         try:
-            location_id_map = merge_location_from_sources(merged_db_path, *required_dbs)
+            location_id_map = merge_location_from_sources(merged_db_path, *required_dbs, conn=merge_write_conn)
             # Si on arrive ici, la fonction s’est bien terminée
             print("🐞 [AFTER merge_location_from_sources]", flush=True)
             print("Location ID Map:", location_id_map, flush=True)
@@ -2677,7 +2951,9 @@ def merge_data():
         print("🐞 [BEFORE merge_usermark_from_sources]", flush=True)
 
         try:
-            usermark_guid_map = merge_usermark_from_sources(merged_db_path, file1_db, file2_db, location_id_map)
+            usermark_mapping, usermark_guid_map = merge_usermark_from_sources(
+                merged_db_path, file1_db, file2_db, location_id_map, conn=merge_write_conn
+            )
 
         except Exception as e:
             import traceback
@@ -2688,31 +2964,28 @@ def merge_data():
         print("🐞 [AFTER merge_usermark_from_sources]", flush=True)
 
         # Après le bloc try/except de merge_usermark_from_sources
-        with sqlite3.connect(merged_db_path) as conn:
-            cursor = conn.cursor()
-            # Vérifier les doublons potentiels
-            cursor.execute("""
-                SELECT UserMarkGuid, COUNT(*) as cnt 
-                FROM UserMark 
-                GROUP BY UserMarkGuid 
-                HAVING cnt > 1
-            """)
-            duplicates = cursor.fetchall()
-            if duplicates:
-                print("⚠️ Attention: GUIDs dupliqués détectés après fusion:")
-                for guid, count in duplicates:
-                    print(f"- {guid}: {count} occurrences")
-            else:
-                print("✅ Aucun GUID dupliqué détecté après fusion")
+        # Les vérifications et écritures ponctuelles qui suivent passent par la connexion partagée
+        cursor = merge_write_conn.cursor()
+        # Vérifier les doublons potentiels
+        cursor.execute("""
+            SELECT UserMarkGuid, COUNT(*) as cnt 
+            FROM UserMark 
+            GROUP BY UserMarkGuid 
+            HAVING cnt > 1
+        """)
+        duplicates = cursor.fetchall()
+        if duplicates:
+            print("⚠️ Attention: GUIDs dupliqués détectés après fusion:")
+            for guid, count in duplicates:
+                print(f"- {guid}: {count} occurrences")
+        else:
+            print("✅ Aucun GUID dupliqué détecté après fusion")
 
         # Gestion spécifique de LastModified
-        conn = sqlite3.connect(merged_db_path)
-        cursor = conn.cursor()
-
+        cursor.execute("BEGIN")
         cursor.execute("DELETE FROM LastModified")
         cursor.execute("INSERT INTO LastModified (LastModified) VALUES (?)", (merge_date,))
-        conn.commit()
-        conn.close()
+        merge_write_conn.commit()
 
         try:
             note_mapping = create_note_mapping(merged_db_path, file1_db, file2_db)
@@ -2723,32 +2996,24 @@ def merge_data():
             traceback.print_exc()
             raise
 
-        # (Ré)ouvrir la connexion pour PlaylistItem
-        conn = sqlite3.connect(merged_db_path)
-        cursor = conn.cursor()
-
         print(f"--> PlaylistItem fusionnés : {len(item_id_map)} items")
 
-        conn.close()
-
         print("\n=== USERMARK VERIFICATION ===")
-        print(f"Total UserMarks mappés (GUIDs) : {len(usermark_guid_map)}")
-        with sqlite3.connect(merged_db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM UserMark")
-            total = cursor.fetchone()[0]
-            print(f"UserMarks dans la DB: {total}")
-            cursor.execute("""
-                SELECT ColorIndex, StyleIndex, COUNT(*) 
-                FROM UserMark 
-                GROUP BY ColorIndex, StyleIndex
-            """)
-            print("Répartition par couleur/style:")
-            for color, style, count in cursor.fetchall():
-                print(f"- Couleur {color}, Style {style}: {count} marques")
+        print(f"Total UserMarks mappés (GUIDs) : {len(usermark_mapping)}")
+        cursor.execute("SELECT COUNT(*) FROM UserMark")
+        total = cursor.fetchone()[0]
+        print(f"UserMarks dans la DB: {total}")
+        cursor.execute("""
+            SELECT ColorIndex, StyleIndex, COUNT(*) 
+            FROM UserMark 
+            GROUP BY ColorIndex, StyleIndex
+        """)
+        print("Répartition par couleur/style:")
+        for color, style, count in cursor.fetchall():
+            print(f"- Couleur {color}, Style {style}: {count} marques")
 
         print(f"Location IDs mappés: {location_id_map}")
-        print(f"UserMark GUIDs mappés: {usermark_guid_map}")
+        print(f"UserMark GUIDs mappés: {usermark_mapping}")
 
         # ===== Vérification pré-fusion complète =====
         print("\n=== VERIFICATION PRE-FUSION ===")
@@ -2768,17 +3033,16 @@ def merge_data():
         print("\n[VÉRIFICATION SCHÉMA]")
 
         def verify_schema(db_path):
+            # Connexion lecture seule en cache (déjà ouverte pour les vérifications précédentes)
             try:
-                conn = sqlite3.connect(db_path)
-                cursor = conn.cursor()
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                tables = [t[0] for t in cursor.fetchall()]
+                tables = [t[0] for t in get_conn(db_path).execute(
+                    "SELECT name FROM sqlite_master WHERE type='table'"
+                )]
                 print(f"Tables dans {os.path.basename(db_path)}: {len(tables)}")
                 required_tables = {'Bookmark', 'Location', 'UserMark', 'Note'}
                 missing = required_tables - set(tables)
                 if missing:
                     print(f"  TABLES MANQUANTES: {missing}")
-                conn.close()
                 return not bool(missing)
             except Exception as e:
                 print(f"  ERREUR: {str(e)}")
@@ -2789,12 +3053,9 @@ def merge_data():
         print("\n[VÉRIFICATION BASE DE DESTINATION]")
         print(f"Vérification {merged_db_path}... ", end="")
         try:
-            conn = sqlite3.connect(merged_db_path)
-            cursor = conn.cursor()
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
             tables = [t[0] for t in cursor.fetchall()]
             print(f"OK ({len(tables)} tables)")
-            conn.close()
         except Exception as e:
             print(f"ERREUR: {str(e)}")
             return jsonify({"error": "Base de destination corrompue"}), 500
@@ -2829,7 +3090,7 @@ def merge_data():
         # --- FUSION BLOCKRANGE ---
         print("\n=== DEBUT FUSION BLOCKRANGE ===")
         try:
-            if not merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db):
+            if not merge_blockrange_from_two_sources(merged_db_path, file1_db, file2_db, conn=merge_write_conn):
                 print("ÉCHEC Fusion BlockRange")
                 return jsonify({"error": "BlockRange merge failed"}), 500
         except Exception as e:
@@ -2838,15 +3099,6 @@ def merge_data():
             traceback.print_exc()
             raise
 
-        # Mapping inverse UserMarkId original → nouveau
-        usermark_guid_map = {}
-        conn = sqlite3.connect(merged_db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT UserMarkId, UserMarkGuid FROM UserMark")
-        for new_id, guid in cursor.fetchall():
-            usermark_guid_map[guid] = new_id
-        conn.close()
-
         # --- Avant fusion Tags et TagMap, on affiche note_mapping ---
         print("📦 Avant merge_tags_and_tagmap (1) :")
         print(f"🔢 note_mapping contient {len(note_mapping)} entrées")
@@ -2861,7 +3113,8 @@ def merge_data():
                 location_id_map,
                 usermark_guid_map,
                 payload.get("choices", {}).get("notes", {}),
-                tag_id_map  # ✅ ici maintenant
+                tag_id_map,  # ✅ ici maintenant
+                conn=merge_write_conn
             )
         except Exception as e:
             import traceback
@@ -2883,7 +3136,8 @@ def merge_data():
                 note_mapping,  # <-- on passe la vraie variable ici
                 location_id_map,
                 item_id_map,
-                payload.get("choices", {}).get("tags", {})
+                payload.get("choices", {}).get("tags", {}),
+                conn=merge_write_conn
             )
         except Exception as e:
             import traceback
@@ -2906,22 +3160,23 @@ def merge_data():
         print(f"Tag ID Map: {tag_id_map}")
         print(f"TagMap ID Map: {tagmap_id_map}")
 
+        # La même connexion sert ensuite aux vérifications et optimisations finales (étapes 11 à 16)
+        conn = merge_write_conn
+        cursor = conn.cursor()
         try:
-            with sqlite3.connect(merged_db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM Tag")
-                tags_count = cursor.fetchone()[0]
-                cursor.execute("SELECT COUNT(*) FROM TagMap")
-                tagmaps_count = cursor.fetchone()[0]
-                print(f"Tags: {tags_count}")
-                print(f"TagMaps: {tagmaps_count}")
-                cursor.execute("""
-                    SELECT COUNT(*) 
-                    FROM TagMap 
-                    WHERE NoteId NOT IN (SELECT NoteId FROM Note)
-                """)
-                orphaned = cursor.fetchone()[0]
-                print(f"TagMaps orphelins: {orphaned}")
+            cursor.execute("SELECT COUNT(*) FROM Tag")
+            tags_count = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM TagMap")
+            tagmaps_count = cursor.fetchone()[0]
+            print(f"Tags: {tags_count}")
+            print(f"TagMaps: {tagmaps_count}")
+            cursor.execute("""
+                SELECT COUNT(*) 
+                FROM TagMap 
+                WHERE NoteId NOT IN (SELECT NoteId FROM Note)
+            """)
+            orphaned = cursor.fetchone()[0]
+            print(f"TagMaps orphelins: {orphaned}")
         except Exception as e:
             print(f"❌ ERREUR dans la vérification des tags : {e}")
             import traceback
@@ -2939,24 +3194,24 @@ def merge_data():
             'PlaylistItemLocationMap',
             'PlaylistItemIndependentMediaMap'
         ]
-        print("\n--- COMPTES AVANT merge_other_tables ---")
-        with sqlite3.connect(merged_db_path) as dbg_conn:
-            dbg_cur = dbg_conn.cursor()
-            for tbl in tables_to_check:
-                dbg_cur.execute(f"SELECT COUNT(*) FROM {tbl}")
-                cnt_merged = dbg_cur.fetchone()[0]
-
-                dbg_cur.execute(f"ATTACH DATABASE ? AS src1", (file1_db,))
-                dbg_cur.execute(f"SELECT COUNT(*) FROM src1.{tbl}")
-                cnt1 = dbg_cur.fetchone()[0]
-                dbg_cur.execute("DETACH DATABASE src1")
-
-                dbg_cur.execute(f"ATTACH DATABASE ? AS src2", (file2_db,))
-                dbg_cur.execute(f"SELECT COUNT(*) FROM src2.{tbl}")
-                cnt2 = dbg_cur.fetchone()[0]
-                dbg_cur.execute("DETACH DATABASE src2")
+        def print_table_counts(label):
+            # Sources attachées une seule fois, tous les comptes en une requête UNION ALL
+            counts_sql = " UNION ALL ".join(
+                f"SELECT '{tbl}', (SELECT COUNT(*) FROM main.{tbl}), "
+                f"(SELECT COUNT(*) FROM src1.{tbl}), (SELECT COUNT(*) FROM src2.{tbl})"
+                for tbl in tables_to_check
+            )
+            merge_write_conn.execute("ATTACH DATABASE ? AS src1", (f"file:{os.path.abspath(file1_db)}?mode=ro",))
+            merge_write_conn.execute("ATTACH DATABASE ? AS src2", (f"file:{os.path.abspath(file2_db)}?mode=ro",))
+            try:
+                for tbl, cnt_merged, cnt1, cnt2 in merge_write_conn.execute(counts_sql).fetchall():
+                    print(f"{label} {tbl}: merged={cnt_merged}, file1={cnt1}, file2={cnt2}")
+            finally:
+                merge_write_conn.execute("DETACH DATABASE src1")
+                merge_write_conn.execute("DETACH DATABASE src2")
 
-                print(f"[AVANT ] {tbl}: merged={cnt_merged}, file1={cnt1}, file2={cnt2}")
+        print("\n--- COMPTES AVANT merge_other_tables ---")
+        print_table_counts("[AVANT ]")
 
         # Fermer toutes les connexions avant les appels suivants
         try:
@@ -2980,23 +3235,7 @@ def merge_data():
 
         # ─── Après merge_other_tables ───────────────────────────────────────────
         print("\n--- COMPTES APRÈS merge_other_tables ---")
-        with sqlite3.connect(merged_db_path) as dbg_conn:
-            dbg_cur = dbg_conn.cursor()
-            for tbl in tables_to_check:
-                dbg_cur.execute(f"SELECT COUNT(*) FROM {tbl}")
-                cnt_merged = dbg_cur.fetchone()[0]
-
-                dbg_cur.execute(f"ATTACH DATABASE ? AS src1", (file1_db,))
-                dbg_cur.execute(f"SELECT COUNT(*) FROM src1.{tbl}")
-                cnt1 = dbg_cur.fetchone()[0]
-                dbg_cur.execute("DETACH DATABASE src1")
-
-                dbg_cur.execute(f"ATTACH DATABASE ? AS src2", (file2_db,))
-                dbg_cur.execute(f"SELECT COUNT(*) FROM src2.{tbl}")
-                cnt2 = dbg_cur.fetchone()[0]
-                dbg_cur.execute("DETACH DATABASE src2")
-
-                print(f"[APRÈS] {tbl}: merged={cnt_merged}, file1={cnt1}, file2={cnt2}")
+        print_table_counts("[APRÈS]")
 
         # 8. Vérification finale des thumbnails
         print("\n[VÉRIFICATION THUMBNAILS ORPHELINS]")
@@ -3023,35 +3262,27 @@ def merge_data():
                 'orphaned_thumbnails': len(orphaned_thumbnails) if 'orphaned_thumbnails' in locals() else 0
             }
         }
-        print(f"Résumé intermédiaire: {playlist_results}")
+        print(f"Résumé intermédiaire: {len(item_id_map)} items, {len(marker_id_map)} markers, "
+              f"médias: {playlist_results['media_status']}")
+        logger.debug("Résumé intermédiaire complet: %s", playlist_results)
 
-        # 11. Vérification de cohérence
+        # 11. Vérification de cohérence et 12. suppression des PlaylistItem orphelins
+        # Un seul DELETE ... RETURNING : le comptage et la suppression partagent le même parcours.
         print("\n=== VERIFICATION COHERENCE ===")
+        conn.commit()
+        cursor.execute("BEGIN IMMEDIATE")
         cursor.execute("""
-            SELECT COUNT(*) 
-              FROM PlaylistItem pi
-             WHERE pi.PlaylistItemId NOT IN (
-                    SELECT PlaylistItemId FROM PlaylistItemLocationMap
-                    UNION
-                    SELECT PlaylistItemId FROM PlaylistItemIndependentMediaMap
-                )
+            DELETE FROM PlaylistItem
+             WHERE PlaylistItemId NOT IN (
+                SELECT PlaylistItemId FROM PlaylistItemLocationMap
+                UNION ALL
+                SELECT PlaylistItemId FROM PlaylistItemIndependentMediaMap
+             )
+            RETURNING PlaylistItemId
         """)
-        orphaned_items = cursor.fetchone()[0]
+        orphaned_items = len(cursor.fetchall())
         status_color = "\033[91m" if orphaned_items > 0 else "\033[92m"
-        print(f"{status_color}Éléments sans parent détectés (non supprimés) : {orphaned_items}\033[0m")
-
-        # 12. Suppression des PlaylistItem orphelins
-        with sqlite3.connect(merged_db_path) as conn_del:
-            cur = conn_del.cursor()
-            cur.execute("""
-                DELETE FROM PlaylistItem
-                 WHERE PlaylistItemId NOT IN (
-                    SELECT PlaylistItemId FROM PlaylistItemLocationMap
-                    UNION
-                    SELECT PlaylistItemId FROM PlaylistItemIndependentMediaMap
-                 )
-            """)
-            conn_del.commit()
+        print(f"{status_color}Éléments sans parent détectés : {orphaned_items}\033[0m")
         print("→ PlaylistItem orphelins supprimés")
 
         # 13. Optimisations finales
@@ -3065,27 +3296,11 @@ def merge_data():
             with open(log_file, "a") as f:
                 f.write(f"[{log_type}] {datetime.now().strftime('%H:%M:%S')} - {message}\n")
 
-        # 13.1 Reconstruction des index
-        print("\nReconstruction des index...")
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='index'")
-        indexes = [row[0] for row in cursor.fetchall() if not row[0].startswith('sqlite_autoindex_')]
-        for index_name in indexes:
-            try:
-                cursor.execute(f"REINDEX {index_name}")
-                log_message(f"Index reconstruit: {index_name}")
-            except sqlite3.Error as e:
-                log_message(f"ERREUR sur index {index_name}: {str(e)}", "ERROR")
-
-        # 13.2 Vérification intégrité
-        print("\nVérification intégrité base de données...")
-        cursor.execute("PRAGMA quick_check")
-        integrity_result = cursor.fetchone()[0]
-        if integrity_result == "ok":
-            log_message("Intégrité de la base: OK")
-        else:
-            log_message(f"ERREUR intégrité: {integrity_result}", "ERROR")
+        # Les index non uniques différés et la vérification d'intégrité sont faits
+        # après la dernière écriture de fusion (update_location_references)
+        conn.commit()
 
-        # 13.3 Vérification clés étrangères
+        # 13.1 Vérification clés étrangères
         cursor.execute("PRAGMA foreign_key_check")
         fk_issues = cursor.fetchall()
         if fk_issues:
@@ -3105,27 +3320,21 @@ def merge_data():
         print(f"{'Éléments:':<20}, {len(item_id_map)}")
         print(f"{'Médias:':<20}, {max_media_id}")
         print(f"{'Nettoyés:':<20}, {orphaned_deleted}")
-        print(f"{'Intégrité:':<20}, {integrity_result}")
         if fk_issues:
             print(f"{'Problèmes FK:':<20} \033[91m{len(fk_issues)}\033[0m")
         else:
             print(f"{'Problèmes FK:':<20} \033[92mAucun\033[0m")
 
-        # 16. Activation du WAL
-        cursor.execute("PRAGMA journal_mode=WAL")
-        cursor.execute("CREATE TABLE IF NOT EXISTS dummy_for_wal (id INTEGER PRIMARY KEY)")
-        cursor.execute("INSERT INTO dummy_for_wal DEFAULT VALUES")
-        cursor.execute("DELETE FROM dummy_for_wal")
-        cursor.execute("DROP TABLE dummy_for_wal")
-        conn.commit()
-        conn.close()
+        # 16. Fin de la phase d'ingestion : la connexion est déjà en WAL (MERGE_PRAGMAS),
+        # on remet seulement un synchronous normal, sans écriture d'amorçage.
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA journal_mode=WAL").fetchone()
 
         # Vérification du mode WAL
-        with sqlite3.connect(merged_db_path) as test_conn:
-            new_wal_status = test_conn.execute("PRAGMA journal_mode").fetchone()[0]
-            print(f"Statut WAL après activation: {new_wal_status}")
-            if new_wal_status != "wal":
-                print("Avertissement: Échec de l'activation WAL")
+        new_wal_status = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        print(f"Statut WAL après activation: {new_wal_status}")
+        if new_wal_status != "wal":
+            print("Avertissement: Échec de l'activation WAL")
 
         print("📍 Avant le résumé final")
 
@@ -3169,17 +3378,13 @@ def merge_data():
             print(f"- Résultat intégrité: {integrity_result}")
             print("✅ Tous les calculs terminés, nettoyage…")
 
-            print("item_id_map keys:", list(item_id_map.keys()))
-            print("location_id_map keys:", list(location_id_map.keys()))
-            print("note_mapping keys:", list(note_mapping.keys()))
-
-            print("📦 Vérification complète de item_id_map AVANT merge_tags_and_tagmap:")
-            for (db_path, old_id), new_id in item_id_map.items():
-                print(f"  FROM {db_path} - OldID: {old_id} → NewID: {new_id}")
-
-            print("🧪 CONTENU DE item_id_map APRÈS merge_playlists:")
-            for k, v in item_id_map.items():
-                print(f"  {k} → {v}")
+            print(f"item_id_map : {len(item_id_map)} entrées, location_id_map : {len(location_id_map)}, "
+                  f"note_mapping : {len(note_mapping)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("location_id_map keys: %s", list(location_id_map.keys()))
+                logger.debug("note_mapping keys: %s", list(note_mapping.keys()))
+                for (db_path, old_id), new_id in item_id_map.items():
+                    logger.debug("  FROM %s - OldID: %s → NewID: %s", db_path, old_id, new_id)
 
             # --- Avant fusion Tags et TagMap, on affiche note_mapping ---
             print("📦 Avant merge_tags_and_tagmap (2) :")
@@ -3195,7 +3400,8 @@ def merge_data():
                     note_mapping,
                     location_id_map,
                     item_id_map,
-                    payload.get("choices", {}).get("tags", {})
+                    payload.get("choices", {}).get("tags", {}),
+                    conn=merge_write_conn
                 )
                 print(f"✔ merge_tags_and_tagmap réussi :")
                 print(f"  Tag ID Map contient {len(tag_id_map)} entrées")
@@ -3212,22 +3418,48 @@ def merge_data():
 
             # 1️⃣ Mise à jour des LocationId résiduels
             print("\n=== MISE À JOUR DES LocationId RÉSIDUELS ===")
-            merge_inputfields(merged_db_path, file1_db, file2_db, location_id_map)
+            merge_inputfields(merged_db_path, file1_db, file2_db, location_id_map, conn=merge_write_conn)
             print("✔ Fusion InputFields terminée")
+            # Pas de tri : location_id_map est rempli file1 puis file2, l'ordre d'insertion
+            # donne déjà la priorité à file2 pour un même ancien LocationId
             location_replacements_flat = {
                 old_id: new_id
-                for (_, old_id), new_id in sorted(location_id_map.items())
+                for (_, old_id), new_id in location_id_map.items()
             }
 
             print("⏳ Appel de update_location_references...")
             try:
-                update_location_references(merged_db_path, location_replacements_flat)
+                update_location_references(merged_db_path, location_replacements_flat, conn=merge_write_conn)
                 print("✔ Mise à jour des références LocationId terminée")
             except Exception as e:
                 import traceback
                 print(f"❌ ERREUR dans update_location_references : {e}")
                 traceback.print_exc()
 
+            # Création des index non uniques, différée après toutes les écritures de fusion :
+            # chaque index est construit en une passe, sans REINDEX (la base livrée est de toute façon
+            # réécrite par VACUUM INTO)
+            print("\nCréation des index différés...")
+            merge_write_conn.execute("BEGIN")
+            for index_sql in deferred_indexes:
+                try:
+                    merge_write_conn.execute(index_sql)
+                except sqlite3.Error as e:
+                    log_message(f"ERREUR création index: {str(e)}", "ERROR")
+            merge_write_conn.commit()
+
+            # Vérification intégrité, une fois les index en place
+            print("\nVérification intégrité base de données...")
+            integrity_result = merge_write_conn.execute("PRAGMA quick_check").fetchone()[0]
+            if integrity_result == "ok":
+                log_message("Intégrité de la base: OK")
+            else:
+                log_message(f"ERREUR intégrité: {integrity_result}", "ERROR")
+
+            # Fin des étapes d'écriture : on libère la connexion partagée avant le nettoyage
+            merge_write_conn.close()
+            merge_write_conn = None
+
             with sqlite3.connect(merged_db_path) as conn:
                 cleanup_playlist_item_location_map(conn)
 
@@ -3251,10 +3483,28 @@ def merge_data():
                 tables_to_drop = [row[0] for row in rows]
                 print(f"🧪 Résultat brut de la requête sqlite_master : {rows}")
                 print(f"🧹 Tables MergeMapping_ détectées : {tables_to_drop}")
+
+                # Index techniques créés uniquement pour la fusion
+                cur.execute("""
+                    SELECT name
+                    FROM sqlite_master
+                    WHERE type='index'
+                      AND LOWER(name) LIKE 'mergeindex_%'
+                """)
+                indexes_to_drop = [row[0] for row in cur.fetchall()]
+
+                # Les DROP ne déclenchent pas de transaction implicite : un seul script
+                # BEGIN/COMMIT évite un commit par table
+                drop_statements = (
+                    [f'DROP TABLE IF EXISTS "{tbl}";' for tbl in tables_to_drop]
+                    + [f'DROP INDEX IF EXISTS "{idx}";' for idx in indexes_to_drop]
+                )
+                if drop_statements:
+                    cleanup_conn.executescript("BEGIN;\n" + "\n".join(drop_statements) + "\nCOMMIT;")
                 for tbl in tables_to_drop:
-                    cur.execute(f"DROP TABLE IF EXISTS {tbl}")
                     print(f"✔ Table supprimée : {tbl}")
-                cleanup_conn.commit()
+                for idx in indexes_to_drop:
+                    print(f"✔ Index supprimé : {idx}")
 
             # 🔍 Vérification juste avant la copie
             print("📄 Vérification taille et date de merged_userData.db juste avant la copie")
@@ -3357,6 +3607,8 @@ def merge_data():
                 conn.close()
             except:
                 pass
+        if merge_write_conn:
+            merge_write_conn.close()
 
 
 # === 🔒 Ancienne méthode de génération ZIP backend (désactivée avec JSZip) ===